@@ -0,0 +1,788 @@
+"""Benchmarks for gel1d
+   ------------------
+
+   Times the processing steps on synthetic gel images.
+   Usage: python benchmark.py
+          python benchmark.py --suite results.json [--compare old.json]
+
+   The suite runs the pipeline on synthetic gels with known bands, at
+   several image sizes, and saves timings and accuracy as JSON; with
+   --compare, it prints the change from a previous results file.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import numpy as np
+import gel1d as gel
+
+
+def synthetic_gel(width,height,lanes,bands=3,noise=0.02,seed=0):
+    """return a synthetic gel image with lanes of gaussian bands
+       and the list of (x1,x2) tuples for the lanes
+    """
+    image,truth = synthetic_gel_truth(width,height,lanes,bands,noise,seed=seed)
+    return image,truth['lanes']
+
+def synthetic_gel_truth(width,height,lanes,bands=3,noise=0.02,gradient=0.0,
+                        angle=0.0,seed=0,ratios=None,keq=0.2,shift=0.5):
+    """return a synthetic gel image and a dictionary with its ground truth:
+       lanes, the (x1,x2) tuples of the lanes before rotation
+       bands, the (position, sigma) of the bands of each lane
+       wells, the (x1,y1,x2,y2) of the wells after rotation
+       gradient adds a linear background rising to gradient at the
+       bottom right corner, angle rotates the gel (skimage rotate with
+       resize, in degrees)
+       if ratios are given, the first band of each lane is the highest
+       and its position follows a langmuir curve with keq and shift:
+       0.8*height*(1-shift*kr/(1+kr)) for kr = keq*ratio
+    """
+    rng = np.random.RandomState(seed)
+    image = np.zeros((height,width))
+    lane_wid = width//lanes
+    margin = lane_wid//8
+    ys = np.arange(height)[:,None]
+    lane_bounds = []
+    lane_bands = []
+    for lane in range(lanes):
+        x1 = lane*lane_wid+margin
+        x2 = (lane+1)*lane_wid-margin
+        lane_bands.append([])
+        for band in range(bands):
+            pos = rng.uniform(0.1,0.9)*height
+            wid = rng.uniform(0.005,0.02)*height
+            hei = rng.uniform(0.3,1.0)
+            if ratios is not None:
+                if band == 0:
+                    kr = keq*ratios[lane]
+                    pos = 0.8*height*(1-shift*kr/(1+kr))
+                    hei = 1.0
+                else:
+                    hei = 0.6*hei
+            image[:,x1:x2] += hei*np.exp(-(ys-pos)**2/(2*wid**2))
+            lane_bands[-1].append((pos,wid))
+        lane_bounds.append((x1,x2))
+    if gradient:
+        image += gradient*(ys/float(height)+
+                           np.arange(width)[None,:]/float(width))/2
+    image += noise*rng.standard_normal(image.shape)
+    wells = (0,0,width-1,0)
+    if angle:
+        from skimage.transform import rotate
+        from ereuss import rotation_transform
+        image = rotate(image,angle,resize=True,mode='edge')
+        tform,shape = rotation_transform((height,width),angle)
+        corners = tform.inverse(np.array([[0,0],[width-1,0]]))
+        wells = tuple(int(round(v)) for v in corners.ravel())
+    image = image-np.min(image)
+    return image/np.max(image),{'lanes':lane_bounds,'bands':lane_bands,
+                                'wells':wells}
+
+def timed(func,*args,**kwargs):
+    """return (result, seconds) for func called with args"""
+    start = time.time()
+    res = func(*args,**kwargs)
+    return res,time.time()-start
+
+def bench_lane_search(widths=(300,600,1200),lane_counts=(5,10,20),
+                      height=200,naive=True):
+    """compare lane search engines across image widths and lane counts"""
+    print('Lane search (find_n_bands)')
+    print('width\tlanes\tnaive(s)\tcumsum(s)\tsame')
+    for width in widths:
+        for lanes in lane_counts:
+            image,_ = synthetic_gel(width,height,lanes)
+            new,t_new = timed(gel.find_n_bands,image,lanes,5,'exhaustive')
+            if naive:
+                old,t_old = timed(gel.find_n_bands,image,lanes,5,'naive')
+                same = old[0]==new[0] and np.array_equal(old[1],new[1])
+            else:
+                t_old,same = float('nan'),'-'
+            print('{0}\t{1}\t{2:.3f}\t\t{3:.3f}\t\t{4}'.format(
+                  width,lanes,t_old,t_new,same))
+
+def search_score(aver,band_count,best):
+    """return the lane search score of the (gap,offset,wid) tuple"""
+    gap,offset,wid = best
+    table = gel.cumulative_profile(aver)
+    return gel.lane_scores(table,np.sum(aver),band_count,
+                           gap,offset,np.array([wid]))[0]
+
+def bench_pyramid(widths=(600,1200,2400,3000),lane_counts=(5,10,20,24),
+                  height=200,seeds=(0,1,2)):
+    """compare pyramid and exhaustive lane search on synthetic gels
+       reports timings, the speedup, the largest lane edge difference in
+       pixels and the relative score loss of the pyramid result
+    """
+    print('Lane search, pyramid vs exhaustive')
+    print('width\tlanes\tseed\tcumsum(s)\tpyramid(s)\tspeedup\t'
+          'edge(px)\tscore loss')
+    for width in widths:
+        for lanes in lane_counts:
+            for seed in seeds:
+                image,_ = synthetic_gel(width,height,lanes,seed=seed)
+                aver = gel.x_profile(image,5)
+                full,t_full = timed(gel.lane_search,aver,lanes)
+                pyr,t_pyr = timed(gel.lane_search_pyramid,aver,lanes)
+                edges = np.abs(np.array(gel.lanes_from_search(full,lanes))-
+                               np.array(gel.lanes_from_search(pyr,lanes)))
+                s_full = search_score(aver,lanes,full)
+                s_pyr = search_score(aver,lanes,pyr)
+                print('{0}\t{1}\t{2}\t{3:.3f}\t\t{4:.3f}\t\t{5:.1f}\t'
+                      '{6}\t\t{7:.2e}'.format(
+                      width,lanes,seed,t_full,t_pyr,t_full/t_pyr,
+                      np.max(edges),(s_full-s_pyr)/s_full))
+
+def bench_peak_fitting(sizes=((600,400,10),(1200,800,20),(2400,1600,24)),
+                       num_gaussians=4,min_height=0.1):
+    """compare per lane and batched gaussian fitting
+       reports timings and the largest relative difference in the peaks
+    """
+    print('Gaussian peak fitting, scalar vs batch')
+    print('width\theight\tlanes\tscalar(s)\tbatch(s)\tmax rel diff')
+    for width,height,lanes in sizes:
+        image,bands = synthetic_gel(width,height,lanes)
+        vals = []
+        for band in bands:
+            profile = gel.band_profile(band,image)
+            vals.append(profile-gel.iterative_baseline(profile,1))
+        scalar,t_scalar = timed(lambda: [gel.gaussian_peaks(v,num_gaussians,
+                                                            min_height)
+                                         for v in vals])
+        batch,t_batch = timed(gel.gaussian_peaks_batch,vals,
+                              num_gaussians,min_height)
+        diff = 0
+        for old,new in zip(scalar,batch):
+            if len(old)!=len(new):
+                diff = float('inf')
+                break
+            for p_old,p_new in zip(old,new):
+                p_old = np.array(p_old,dtype=float)
+                rel = np.abs(p_old-np.array(p_new,dtype=float))/np.abs(p_old)
+                diff = max(diff,np.max(rel))
+        print('{0}\t{1}\t{2}\t{3:.3f}\t\t{4:.3f}\t\t{5:.2e}'.format(
+              width,height,lanes,t_scalar,t_batch,diff))
+
+def bench_width_fit(width=1200,height=800,lanes=20,num_gaussians=4):
+    """compare cost evaluations and timings of the gaussian width fit
+       with minimize_scalar and with newton_width, peak by peak
+    """
+    from scipy.optimize import minimize_scalar
+    image,bands = synthetic_gel(width,height,lanes)
+    evals_brent = []
+    evals_newton = []
+    t_brent = t_newton = 0
+    diff = 0
+    for band in bands:
+        profile = gel.band_profile(band,image)
+        current = profile-gel.iterative_baseline(profile,1)
+        xs = np.arange(len(current))
+        for p in range(num_gaussians):
+            b = np.argmax(current)
+            a = current[b]
+            res,secs = timed(minimize_scalar,gel.gaussian_cost,
+                             args=(xs,current,a,b))
+            t_brent += secs
+            evals_brent.append(res.nfev)
+            (c,evals),secs = timed(gel.newton_width,(xs-b)**2.0,current,a,
+                                   gel.half_max_width(current,a,b),
+                                   1e-2,10.0*len(current)**2)
+            t_newton += secs
+            evals_newton.append(evals)
+            diff = max(diff,abs(c-res.x)/res.x)
+            current = current-gel.gauss_curve(xs,a,b,res.x)
+    print('Gaussian width fit, minimize_scalar vs newton_width')
+    print('method\tevals/peak\ttime(s)')
+    print('brent\t{0:.1f}\t\t{1:.3f}'.format(np.mean(evals_brent),t_brent))
+    print('newton\t{0:.1f}\t\t{1:.3f}'.format(np.mean(evals_newton),t_newton))
+    print('max rel diff in width: {0:.2e}'.format(diff))
+
+def same_lane(a,b,atol=1e-12,rtol=1e-6):
+    """True if the (profile,baseline,peaks,band) tuples a and b have equal
+       profiles, baselines within atol and peaks within rtol
+    """
+    return (np.array_equal(a[0],b[0]) and
+            np.allclose(a[1],b[1],rtol=0,atol=atol) and
+            len(a[2]) == len(b[2]) and
+            np.allclose(np.reshape(a[2],(-1,4)),np.reshape(b[2],(-1,4)),
+                        rtol=rtol,atol=0))
+
+def bench_workers(workers=(1,2,4,8),width=2400,height=1600,lanes=24,
+                  fitter='scalar'):
+    """time profiles_and_baselines over pools of worker processes
+       profiles must be equal to the serial ones; workers fit each lane
+       baseline alone instead of all at once, which differs by rounding
+       only, so baselines must agree to 1e-12 and peaks to a relative
+       1e-6 (the minimize_scalar tolerance amplifies the rounding)
+    """
+    image,bands = synthetic_gel(width,height,lanes)
+    print('Lane profiling with worker processes ({0})'.format(fitter))
+    print('workers\ttime(s)\tspeedup\tsame')
+    serial = None
+    for count in workers:
+        res,secs = timed(gel.profiles_and_baselines,bands,image,0.1,4,1,0,
+                         fitter,count)
+        if serial is None:
+            serial = (res,secs)
+        same = all(same_lane(a,b) for a,b in zip(serial[0],res))
+        print('{0}\t{1:.3f}\t{2:.2f}\t{3}'.format(count,secs,
+                                                   serial[1]/secs,same))
+
+def bench_baselines(width=2400,height=1600,lanes=24,degrees=(1,3,5)):
+    """compare polyfit, cached QR and batched lane baselines"""
+    image,bands = synthetic_gel(width,height,lanes)
+    profiles = [gel.band_profile(band,image) for band in bands]
+    print('Lane baselines, polyfit vs cached QR vs batched')
+    print('degree\tpolyfit(s)\tqr(s)\tbatch(s)\tmax rel diff')
+    for degree in degrees:
+        old,t_old = timed(lambda: [gel.iterative_baseline(p,degree,'polyfit')
+                                   for p in profiles])
+        qr,t_qr = timed(lambda: [gel.iterative_baseline(p,degree)
+                                 for p in profiles])
+        batch,t_batch = timed(gel.iterative_baselines,profiles,degree)
+        diff = max(np.max(np.abs(o-n))/np.max(np.abs(o))
+                   for o,n in zip(old,batch))
+        print('{0}\t{1:.3f}\t\t{2:.3f}\t{3:.3f}\t\t{4:.2e}'.format(
+              degree,t_old,t_qr,t_batch,diff))
+
+def bench_curve_fits(seeds=(0,1,2,3),replicas=500,noise=1.0):
+    """compare scipy and batched Levenberg-Marquardt langmuir and hill
+       fits on noisy synthetic mobilities
+    """
+    ratios = np.array([0,1,2,5,10,20,50.0])
+    kr = 0.2*ratios
+    clean = 100-70*kr/(1+kr)
+    print('Langmuir and Hill fits, scipy vs lm')
+    print('seed\tscipy(s)\tlm(s)\tkeq diff\tmin_mob diff\terr diff\thill diff')
+    for seed in seeds:
+        rng = np.random.RandomState(seed)
+        mobility = clean+rng.normal(0,noise,len(ratios))
+        old,t_old = timed(gel.langmuir,ratios,mobility,replicas)
+        new,t_new = timed(gel.langmuir,ratios,mobility,replicas,solver='lm')
+        rel = np.abs(np.array(old)-np.array(new))/np.abs(np.array(old))
+        h_old = gel.hill(ratios,mobility)[1]
+        h_new = gel.hill(ratios,mobility,'lm')[1]
+        print('{0}\t{1:.3f}\t\t{2:.3f}\t{3:.1e}\t\t{4:.1e}\t\t{5:.1e}\t\t{6:.1e}'.format(
+              seed,t_old,t_new,rel[0],rel[1],rel[2],
+              np.max(np.abs(h_old-h_new)/np.abs(h_old))))
+
+def bench_transform(sizes=((1500,1000),(3000,2000),(6000,4000)),
+                    wells=((0.1,0.12,0.9,0.1),(0.2,0.3,0.6,0.28)),
+                    lane_length=0.6):
+    """compare rotate and crop ROI transforms of EReuss.transform_image
+       reports timings and the largest difference in the lanes region
+    """
+    from ereuss import EReuss
+    print('ROI transform, rotate vs crop')
+    print('width\theight\trotate(s)\tcrop(s)\tshape\t\tmax diff')
+    for width,height in sizes:
+        image,_ = synthetic_gel(width,height,10)
+        for x1,y1,x2,y2 in wells:
+            ereuss = EReuss()
+            ereuss.original = image
+            ereuss.well_x1,ereuss.well_x2 = int(x1*width),int(x2*width)
+            ereuss.well_y1,ereuss.well_y2 = int(y1*height),int(y2*height)
+            ereuss.lane_length = int(lane_length*height)
+            old,t_old = timed(ereuss.rotate_and_clip)
+            new,t_new = timed(ereuss.crop_and_rotate)
+            if old.shape==new.shape:
+                diff = np.max(np.abs(old-new))
+            else:
+                diff = float('inf')
+            print('{0}\t{1}\t{2:.3f}\t\t{3:.3f}\t{4}\t{5:.2e}'.format(
+                  width,height,t_old,t_new,new.shape,diff))
+
+def peak_memory(func,*args):
+    """return (result, seconds, peak MB allocated by numpy) for func,
+       peak is nan without tracemalloc (python 2)
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        res,secs = timed(func,*args)
+        return res,secs,float('nan')
+    tracemalloc.start()
+    res,secs = timed(func,*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return res,secs,peak/1024.0**2
+
+def bench_loading(sizes=((2000,1500),(6000,4000),(10000,8000)),rgb=False):
+    """compare load modes of gel1d.load_image_mode on uncompressed 16 bit
+       TIFF files, reports timings, peak numpy memory and the largest
+       difference to the memory mode
+    """
+    import tifffile
+    print('Image loading, 16 bit TIFF{0}'.format(' RGB' if rgb else ''))
+    print('width\theight\tmode\ttime(s)\tpeak(MB)\tmax diff')
+    for width,height in sizes:
+        image,_ = synthetic_gel(width//10,height//10,5)
+        image = np.kron(1-image,np.ones((10,10)))
+        image = (image*60000).astype(np.uint16)
+        if rgb:
+            image = np.dstack([image,image//2,image//4])
+        fd,file_name = tempfile.mkstemp(suffix='.tif')
+        os.close(fd)
+        tifffile.imwrite(file_name,image)
+        del image
+        try:
+            ref = None
+            for mode in gel.LOAD_MODES:
+                res,secs,peak = peak_memory(gel.load_image_mode,file_name,
+                                            'average','auto',mode)
+                if ref is None:
+                    ref = res
+                print('{0}\t{1}\t{2}\t{3:.3f}\t{4:.0f}\t\t{5:.2e}'.format(
+                      width,height,mode,secs,peak,np.max(np.abs(ref-res))))
+                del res
+            del ref
+        finally:
+            os.remove(file_name)
+
+def synthetic_tiff(file_name,size_mb,width=8192):
+    """write an uncompressed 16 bit TIFF of about size_mb megabytes row
+       block by row block, without holding the image in memory
+    """
+    import tifffile
+    height = int(size_mb*1024**2)//(2*width)
+    tifffile.imwrite(file_name,shape=(height,width),dtype=np.uint16)
+    offset = tifffile.TiffFile(file_name).pages[0].dataoffsets[0]
+    rng = np.random.RandomState(0)
+    fil = open(file_name,'r+b')
+    fil.seek(offset)
+    for start in range(0,height,256):
+        rows = min(256,height-start)
+        fil.write(rng.randint(0,65535,(rows,width)).astype(np.uint16).tobytes())
+    fil.close()
+
+def bench_upload(size_mb=500,chunk=1<<20):
+    """upload a synthetic TIFF of size_mb through a local HTTP server
+       using erupload, report throughput, peak RSS growth of the process
+       (Linux, KB) and whether the saved file is identical
+    """
+    import filecmp
+    import resource
+    import threading
+    import erupload
+    try:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from httplib import HTTPConnection
+    except ImportError:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from http.client import HTTPConnection
+    folder = tempfile.mkdtemp()
+    source = os.path.join(folder,'upload.tif')
+    target = os.path.join(folder,'saved.tif')
+    synthetic_tiff(source,size_mb)
+    boundary = '----ereussbenchmarkboundary'
+    stats = erupload.UploadStats()
+    results = []
+
+    class UploadHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            results.append(erupload.save_multipart_file(
+                self.rfile,boundary,int(self.headers['content-length']),
+                target,stats=stats))
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self,*args):
+            pass
+
+    server = HTTPServer(('127.0.0.1',0),UploadHandler)
+    thread = threading.Thread(target=server.handle_request)
+    thread.start()
+    head = ('--{0}\r\nContent-Disposition: form-data; name="file"; '
+            'filename="upload.tif"\r\nContent-Type: image/tiff\r\n\r\n'
+            ).format(boundary).encode('latin-1')
+    tail = '\r\n--{0}--\r\n'.format(boundary).encode('latin-1')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn = HTTPConnection('127.0.0.1',server.server_address[1])
+    conn.putrequest('POST','/upload')
+    conn.putheader('Content-Type','multipart/form-data; boundary='+boundary)
+    conn.putheader('Content-Length',str(len(head)+os.path.getsize(source)+
+                                        len(tail)))
+    conn.endheaders()
+    conn.send(head)
+    fil = open(source,'rb')
+    data = fil.read(chunk)
+    while data:
+        conn.send(data)
+        data = fil.read(chunk)
+    fil.close()
+    conn.send(tail)
+    conn.getresponse().read()
+    thread.join()
+    server.server_close()
+    growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss-rss
+    print('Multipart upload through a local server')
+    print('MB\tok\ttime(s)\tMB/s\tpeak RSS growth(KB)\tsame')
+    print('{0}\t{1}\t{2:.2f}\t{3:.1f}\t{4}\t\t\t{5}'.format(
+          size_mb,results[0][0],stats.seconds,stats.throughput(),growth,
+          filecmp.cmp(source,target,False)))
+    for name in (source,target):
+        if os.path.exists(name):
+            os.remove(name)
+    os.rmdir(folder)
+
+def bench_plots(width=1200,height=800,lanes=20,num_gaussians=4,repeats=3):
+    """compare pyplot figures of plot_band_peaks and save_band_profile
+       with PlotRenderer at interactive and archive DPI
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    image,bands = synthetic_gel(width,height,lanes)
+    found,aver = gel.find_n_bands(image,lanes,5)
+    profiles = gel.profiles_and_baselines(bands,image,0.1,num_gaussians,1)
+    folder = tempfile.mkdtemp()
+    out = os.path.join(folder,'plot.png')
+    renderer = gel.PlotRenderer()
+    runs = [('pyplot',300,lambda: gel.plot_band_peaks(profiles,out,10),
+                          lambda: gel.save_band_profile(aver,found,out))]
+    for dpi in (gel.ARCHIVE_DPI,100):
+        for debug in (True,False):
+            runs.append(('renderer',dpi,
+                         lambda dpi=dpi,debug=debug: renderer.band_peaks(
+                             profiles,out,10,debug,dpi),
+                         lambda dpi=dpi: renderer.band_profile(aver,found,out,
+                                                               dpi)))
+    print('Band plots, {0} lanes with {1} peaks'.format(lanes,num_gaussians))
+    print('plotter\tdpi\tdebug\tpeaks(s)\tprofile(s)')
+    for ix,(name,dpi,peaks,profile) in enumerate(runs):
+        t_peaks = min(timed(peaks)[1] for r in range(repeats))
+        t_profile = min(timed(profile)[1] for r in range(repeats))
+        debug = name=='pyplot' or ix%2==1
+        print('{0}\t{1}\t{2}\t{3:.3f}\t\t{4:.3f}'.format(
+              name,dpi,debug,t_peaks,t_profile))
+    for name in os.listdir(folder):
+        os.remove(os.path.join(folder,name))
+    os.rmdir(folder)
+
+def bench_serializers(lengths=(1000,10000,50000)):
+    """compare string concatenation with ereuss.array_as_csv"""
+    from ereuss import array_as_csv
+
+    def concatenated(array):
+        res = ''
+        for x in array:
+            res = res+str(x)+';'
+        return res[:-1]
+    print('Profile CSV serialization')
+    print('length\tconcat(s)\tjoin(s)\tsame')
+    for length in lengths:
+        values = np.random.RandomState(0).rand(length)
+        old,t_old = timed(concatenated,values)
+        new,t_new = timed(array_as_csv,values)
+        print('{0}\t{1:.3f}\t\t{2:.3f}\t{3}'.format(length,t_old,t_new,
+                                                     old==new))
+
+def bench_incremental(width=2400,height=1600,lanes=24,num_gaussians=4,
+                      fitter='scalar'):
+    """time BandProfiler.find_peaks after a full fit, an edit of one lane
+       and a higher minimum peak height
+    """
+    from ereuss import BandProfiler
+    image,bands = synthetic_gel(width,height,lanes)
+    profiler = BandProfiler()
+    profiler.bands = list(bands)
+    profiler.num_gaussians = num_gaussians
+    profiler.peak_fitter = fitter
+    print('Incremental peak fitting ({0})'.format(fitter))
+    print('change\t\ttime(s)')
+    t_full = timed(profiler.find_peaks,image)[1]
+    print('all lanes\t{0:.3f}'.format(t_full))
+    profiler.bands[lanes//2] = (bands[lanes//2][0]+1,bands[lanes//2][1])
+    print('one lane\t{0:.3f}'.format(timed(profiler.find_peaks,image)[1]))
+    profiler.min_peak_height = 30
+    print('min height\t{0:.3f}'.format(timed(profiler.find_peaks,image)[1]))
+
+def bench_adaptive(width=2400,height=1600,lanes=24,num_gaussians=8,
+                   noise_floors=(0,3,5,10),flat_lanes=6):
+    """time the peak fits of a gel with 3 bands per lane and flat_lanes
+       empty lanes, fitting num_gaussians per lane or stopping at the
+       noise floor, and count the fits done and skipped, and the fits
+       done per lane with bands (counted on those lanes alone, with the
+       last fit dropped by the noise floor)
+    """
+    import erprofile
+    image,bands = synthetic_gel(width,height,lanes)
+    rng = np.random.RandomState(1)
+    for x1,x2 in bands[:flat_lanes]:
+        image[:,x1:x2] = np.median(image)+0.02*rng.standard_normal(
+                                                        (height,x2-x1))
+    enabled = erprofile.enabled
+    erprofile.enable()
+    print('Adaptive peak fitting ({0} gaussians, {1} flat lanes)'.format(
+          num_gaussians,flat_lanes))
+    print('fitter	floor	fits	skipped	flat	fits/band lane	'
+          'peaks/band lane	time(s)')
+    band_lanes = lanes-flat_lanes
+
+    def fits_done(bands,floor):
+        erprofile.stats.clear()
+        res = gel.profiles_and_baselines(bands,image,0,num_gaussians,1,0,
+                                         fitter,noise_floor=floor)
+        counters = dict(erprofile.stats.counter_items())
+        return res,counters.get('gel1d.gaussian_fits',
+                                sum(len(p[2]) for p in res)),counters
+
+    try:
+        for fitter in ('scalar','batch'):
+            for floor in noise_floors:
+                (res,fits,counters),secs = timed(fits_done,bands,floor)
+                band_res,band_fits,_ = fits_done(bands[flat_lanes:],floor)
+                print('{0}\t{1}\t{2}\t{3}\t{4}\t{5:.2f}\t\t{6:.2f}\t\t'
+                      '{7:.3f}'.format(
+                      fitter,floor,fits,
+                      counters.get('gel1d.gaussian_fits_skipped',0),
+                      counters.get('gel1d.flat_lanes',0),
+                      float(band_fits)/band_lanes,
+                      np.mean([len(p[2]) for p in band_res]),secs))
+    finally:
+        erprofile.enable(enabled)
+        erprofile.stats.clear()
+
+def overlapping_profiles(lanes,rows,peaks,spacing=3.0,noise=0.01,seed=0):
+    """return (lanes x rows) profiles of peaks gaussian bands each, with
+       neighbours spacing standard deviations apart, and their centers
+    """
+    rng = np.random.RandomState(seed)
+    xs = np.arange(rows)
+    sigma = rows/(spacing*(peaks+3.0))
+    centers = (np.arange(peaks)+2)*spacing*sigma+ \
+              rng.uniform(-0.3,0.3,(lanes,peaks))*sigma
+    heights = rng.uniform(0.3,1.0,(lanes,peaks))
+    profiles = noise*rng.standard_normal((lanes,rows))
+    for k in range(peaks):
+        profiles += heights[:,k:k+1]*np.exp(-(xs-centers[:,k:k+1])**2/
+                                            (2*sigma**2))
+    return profiles,centers
+
+def center_error(centers,peaks):
+    """mean distance from each true center to the nearest fitted peak"""
+    errors = [np.min(np.abs(c-np.array([p[1] for p in lane_peaks])))
+              for cs,lane_peaks in zip(centers,peaks) for c in cs
+              if len(lane_peaks)>0]
+    return np.mean(errors)
+
+def bench_refine(lanes=24,rows=1600,peak_counts=(2,4,8,16,32)):
+    """time refine_peaks after gaussian_peaks_batch on lanes of
+       overlapping bands, and compare the center errors
+    """
+    print('Joint peak refinement ({0} lanes)'.format(lanes))
+    print('peaks	greedy(s)	refine(s)	ms/peak	error greedy	error refined')
+    for count in peak_counts:
+        profiles,centers = overlapping_profiles(lanes,rows,count)
+        greedy,t_greedy = timed(gel.gaussian_peaks_batch,profiles,count,0.05)
+        refined,t_refine = timed(gel.refine_peaks,profiles,greedy)
+        print('{0}\t{1:.3f}\t\t{2:.3f}\t\t{3:.3f}\t{4:.3f}\t\t{5:.3f}'.format(
+              count,t_greedy,t_refine,1000*t_refine/(lanes*count),
+              center_error(centers,greedy),center_error(centers,refined)))
+
+def x_profile_copy(original,bl_degree=1):
+    """x_profile computed on full float64 copies of the image"""
+    img = original.astype(float)-np.percentile(original,50)
+    img[img<0] = 0
+    aver = np.average(img/np.max(img),axis=0)
+    aver = aver-gel.iterative_baseline(aver,bl_degree)
+    aver[aver<0] = 0
+    return aver/np.max(aver)
+
+def bench_extraction(sizes=((2400,1600),(6000,4000),(10000,8000)),lanes=24):
+    """time and memory of the x profile and the lane profiles, against
+       float64 copies and one np.average per lane
+    """
+    print('Profile extraction ({0} lanes)'.format(lanes))
+    print('size		step	copy(s)	MB	new(s)	MB	max diff')
+    for width,height in sizes:
+        image,bands = synthetic_gel(width,height,lanes)
+        old,t_old = timed(x_profile_copy,image)
+        new,t_new = timed(gel.x_profile,image,1)
+        mb_old = peak_memory(x_profile_copy,image)[2]
+        mb_new = peak_memory(gel.x_profile,image,1)[2]
+        print('{0}x{1}\tx\t{2:.3f}\t{3:.0f}\t{4:.3f}\t{5:.0f}\t{6:.1e}'.format(
+              width,height,t_old,mb_old,t_new,mb_new,np.max(np.abs(old-new))))
+
+        def per_lane(bands,image):
+            return np.array([np.average(image[:,b[0]:b[1]],axis=1)
+                             for b in bands])
+
+        old,t_old = timed(per_lane,bands,image)
+        new,t_new = timed(gel.lane_profiles,bands,image)
+        mb_old = peak_memory(per_lane,bands,image)[2]
+        mb_new = peak_memory(gel.lane_profiles,bands,image)[2]
+        print('{0}x{1}\tlanes\t{2:.3f}\t{3:.0f}\t{4:.3f}\t{5:.0f}\t{6:.1e}'.format(
+              width,height,t_old,mb_old,t_new,mb_new,np.max(np.abs(old-new))))
+
+SUITE_SIZES = ((600,400),(1200,800),(2400,1600))
+SUITE_RATIOS = np.array([0,0.5,1,2,3,5,7,10,15,20,30,50.0])
+
+def band_errors(truth,band_profiles):
+    """return (found fraction, median and max position error in pixels)
+       of the true bands matched to the nearest fitted peak of their lane
+    """
+    errors = []
+    found = 0
+    count = 0
+    for bands,(bf,ys,peaks,b) in zip(truth,band_profiles):
+        positions = np.array([p[1] for p in peaks],dtype=float)
+        for pos,sigma in bands:
+            count += 1
+            if len(positions)==0:
+                continue
+            err = np.min(np.abs(positions-pos))
+            if err<=2*sigma:
+                found += 1
+                errors.append(err)
+    if not errors:
+        return found/float(count),float('nan'),float('nan')
+    return found/float(count),float(np.median(errors)),float(np.max(errors))
+
+def suite_run(width,height,seed=0,bands=3,noise=0.02,gradient=0.2,angle=2.0,
+              ratios=SUITE_RATIOS,keq=0.2):
+    """time the pipeline on one synthetic gel, return dictionary of
+       stage seconds and accuracy against the ground truth
+       lane edges are compared after removing their median shift, which
+       the clipping of rotated gels introduces
+    """
+    from skimage import io
+    from ereuss import EReuss
+    lanes = len(ratios)
+    image,truth = synthetic_gel_truth(width,height,lanes,bands,noise,gradient,
+                                      angle,seed,ratios,keq)
+    folder = tempfile.mkdtemp()
+    image_file = os.path.join(folder,'gel.png')
+    io.imsave(image_file,(image*65535).astype(np.uint16),check_contrast=False)
+    seconds = {}
+
+    def stage(name,func,*args,**kwargs):
+        res,seconds[name] = timed(func,*args,**kwargs)
+        return res
+    original = stage('load_image',gel.load_image,image_file)
+    stage('load_image_tiled',gel.load_image_mode,image_file,'average','auto',
+          'tiled')
+    ereuss = EReuss()
+    ereuss.original = original
+    ereuss.well_x1,ereuss.well_y1,ereuss.well_x2,ereuss.well_y2 = truth['wells']
+    ereuss.lane_length = height
+    processed = stage('transform_image',ereuss.crop_and_rotate)
+    stage('x_profile',gel.x_profile,processed,5)
+    found,aver = stage('find_n_bands',gel.find_n_bands,processed,lanes,5)
+    profiles = stage('profiles_and_baselines',gel.profiles_and_baselines,
+                     found,processed,0.1,bands,1,0,'batch')
+    peak_vols = gel.calc_peaks(profiles)
+    mobility = np.array([pv[0][0] if pv else np.nan for pv in peak_vols],
+                        dtype=float)
+    fit = stage('langmuir',gel.langmuir,ratios,mobility,200,solver='lm')
+    stage('hill',gel.hill,ratios,mobility,'lm')
+    stage('report_peaks',gel.report_peaks,peak_vols,
+          os.path.join(folder,'bands.csv'))
+    ereuss.band_profiler = gel_profiler(found,profiles,peak_vols)
+    stage('save_profiles',ereuss.save_profiles,os.path.join(folder,'gel.xml'))
+    stage('save_profile_arrays',ereuss.save_profile_arrays,
+          os.path.join(folder,'gel.npz'))
+    for name in os.listdir(folder):
+        os.remove(os.path.join(folder,name))
+    os.rmdir(folder)
+    edges = np.array(found)-np.array(truth['lanes'])
+    shift = np.median(edges)
+    fraction,median,worst = band_errors(truth['bands'],profiles)
+    return {'width':width,'height':height,'lanes':lanes,'seed':seed,
+            'seconds':seconds,
+            'accuracy':{'lane_shift_px':float(shift),
+                        'lane_edge_max_px':float(np.max(np.abs(edges-shift))),
+                        'bands_found':fraction,
+                        'band_pos_median_px':median,
+                        'band_pos_max_px':worst,
+                        'keq_rel_error':float(abs(fit[0]-keq)/keq)}}
+
+def gel_profiler(bands,band_profiles,peak_vols):
+    """return a BandProfiler holding the given results"""
+    from ereuss import BandProfiler
+    profiler = BandProfiler()
+    profiler.bands = bands
+    profiler.band_profiles = band_profiles
+    profiler.peak_vols = peak_vols
+    return profiler
+
+def run_suite(output,sizes=SUITE_SIZES,seeds=(0,1)):
+    """run suite_run for all sizes and seeds, save results as JSON"""
+    runs = []
+    for width,height in sizes:
+        for seed in seeds:
+            runs.append(suite_run(width,height,seed))
+            print_run(runs[-1])
+    results = {'time':time.strftime('%Y-%m-%d %H:%M:%S'),
+               'python':platform.python_version(),
+               'numpy':np.__version__,
+               'platform':platform.platform(),
+               'runs':runs}
+    fil = open(output,'w')
+    json.dump(results,fil,indent=1,sort_keys=True)
+    fil.close()
+    return results
+
+def print_run(run):
+    print('{0}x{1} seed {2}'.format(run['width'],run['height'],run['seed']))
+    for name,secs in sorted(run['seconds'].items()):
+        print('  {0:24}{1:.4f}s'.format(name,secs))
+    for name,value in sorted(run['accuracy'].items()):
+        print('  {0:24}{1:.4g}'.format(name,value))
+
+def compare_results(old,new):
+    """print the ratio new/old of the stage timings and the accuracy
+       values of the runs with the same size and seed
+    """
+    old_runs = dict(((r['width'],r['height'],r['seed']),r) for r in old['runs'])
+    print('Compared with results of {0}'.format(old['time']))
+    print('size\t\tseed\tstage\t\t\told(s)\tnew(s)\tnew/old')
+    for run in new['runs']:
+        key = (run['width'],run['height'],run['seed'])
+        if key not in old_runs:
+            continue
+        base = old_runs[key]
+        size = '{0}x{1}'.format(run['width'],run['height'])
+        for name,secs in sorted(run['seconds'].items()):
+            if name in base['seconds']:
+                old_secs = base['seconds'][name]
+                print('{0}\t{1}\t{2:24}{3:.4f}\t{4:.4f}\t{5:.2f}'.format(
+                      size,run['seed'],name,old_secs,secs,
+                      secs/max(old_secs,1e-9)))
+        for name,value in sorted(run['accuracy'].items()):
+            if name in base['accuracy']:
+                print('{0}\t{1}\t{2:24}{3:.4g}\t{4:.4g}'.format(
+                      size,run['seed'],name,base['accuracy'][name],value))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='gel1d benchmarks')
+    parser.add_argument('--suite',default=None,
+                        help='run the suite and save results to this file')
+    parser.add_argument('--compare',default=None,
+                        help='results file of a previous suite run')
+    args = parser.parse_args()
+    if args.suite is not None:
+        results = run_suite(args.suite)
+        if args.compare is not None:
+            compare_results(json.load(open(args.compare)),results)
+        raise SystemExit
+    bench_lane_search()
+    bench_pyramid()
+    bench_peak_fitting()
+    bench_width_fit()
+    bench_workers()
+    bench_baselines()
+    bench_curve_fits()
+    bench_transform()
+    bench_loading()
+    bench_upload()
+    bench_plots()
+    bench_serializers()
+    bench_incremental()
+    bench_adaptive()
+    bench_refine()
+    bench_extraction()
@@ -0,0 +1,241 @@
+"""eReuss batch processing
+   ---------------------
+
+   Runs the eReuss pipeline without the web interface over a directory
+   or glob of gel images:
+       load_image, transform_image, find_bands, build_report, archive_report
+
+   Usage:
+       python erbatch.py [-p profile.json|profile.ini] [-o output]
+                         [-w workers] [-c cache] [-t] [--force] images...
+
+   The profile sets the attributes of EReuss (section "ereuss") and of
+   its BandProfiler (section "band_profiler"), as JSON objects or INI
+   sections, e.g.
+
+       {"ereuss": {"invert": "auto", "lane_count": 12},
+        "band_profiler": {"num_gaussians": 2, "min_peak_height": 5}}
+
+   Each gel is written to output/<gel name>/, and output/summary.csv
+   has one line per gel. Zip files written by a previous run are read
+   back with EReuss.load_archive and only their reports are written
+   again, without image processing. Gels whose archive is newer than both the image
+   and the profile are skipped unless --force is given. With -c, stage
+   results are also kept in a cache folder so that reprocessing with
+   changed report parameters skips the unchanged stages. With -t, each
+   report ends with the timings of the processing stages of its gel.
+"""
+
+from __future__ import print_function
+import matplotlib
+matplotlib.use('Agg')
+import argparse
+import glob
+import json
+import os
+import time
+import zipfile
+from multiprocessing import Pool
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+from skimage.io import imsave
+from ereuss import EReuss
+import gel1d as gel
+from ercache import StageCache
+import erprofile
+import htmlconstants as htc
+
+IMAGE_EXTENSIONS = ('.png','.jpg','.jpeg','.tif','.tiff','.bmp','.gif')
+ARCHIVE_EXTENSIONS = ('.zip',)
+
+SUMMARY_FILE = 'summary.csv'
+SUMMARY_COLUMNS = ['gel','status','lanes','peaks','keq','keq_error',
+                   'seconds']
+
+
+def load_profile(file_name):
+    """return dictionary of settings dictionaries from JSON or INI file"""
+    if file_name is None:
+        return {}
+    if file_name.lower().endswith('.json'):
+        with open(file_name) as fil:
+            return json.load(fil)
+    parser = RawConfigParser()
+    parser.optionxform = str
+    parser.read(file_name)
+    return dict((section,dict(parser.items(section)))
+                for section in parser.sections())
+
+def apply_settings(obj,settings):
+    """set attributes of obj from settings, converted to the type of
+       the current value of each attribute
+    """
+    for name,value in settings.items():
+        if not hasattr(obj,name):
+            raise ValueError('Unknown setting: '+name)
+        attr = getattr(obj,name)
+        if type(attr) is bool:
+            if not isinstance(value,bool):
+                value = str(value).strip().upper() in ('TRUE','YES','1')
+        elif type(attr) is int:
+            value = int(value)
+        elif type(attr) is float:
+            value = float(value)
+        setattr(obj,name,value)
+
+def find_images(patterns):
+    """return sorted list of image and archive files in the directories
+       or globs
+    """
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern,'*')
+        for file_name in glob.glob(pattern):
+            if file_name.lower().endswith(IMAGE_EXTENSIONS+ARCHIVE_EXTENSIONS):
+                files.append(file_name)
+    return sorted(set(files))
+
+def gel_name(image_file):
+    return os.path.splitext(os.path.basename(image_file))[0].replace(' ','_')
+
+def archive_path(image_file,output):
+    name = gel_name(image_file)
+    return os.path.join(output,name,name+'.zip')
+
+def up_to_date(image_file,output,profile_file=None):
+    """True if the archive of the gel is newer than image and profile"""
+    archive = archive_path(image_file,output)
+    if not os.path.exists(archive):
+        return False
+    newest = os.path.getmtime(image_file)
+    if profile_file is not None:
+        newest = max(newest,os.path.getmtime(profile_file))
+    return os.path.getmtime(archive)>=newest
+
+def process_gel(task):
+    """run the pipeline on one gel, return its summary row"""
+    image_file,output,profile,cache_folder,timings = task
+    erprofile.enable(timings)
+    start = time.time()
+    name = gel_name(image_file)
+    row = {'gel':name}
+    try:
+        path = os.path.join(output,name)+os.sep
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        archive = archive_path(image_file,output)
+        cache = None
+        if cache_folder is not None:
+            cache = StageCache(folder=cache_folder)
+        ereuss = EReuss(cache)
+        if image_file.lower().endswith(ARCHIVE_EXTENSIONS):
+            ereuss.load_archive(image_file)
+            zf = zipfile.ZipFile(image_file)
+            image = zf.read(htc.CURRENT_IMAGE)
+            zf.close()
+            if os.path.exists(archive):
+                os.remove(archive)
+            open(path+htc.CURRENT_IMAGE,'wb').write(image)
+        else:
+            if os.path.exists(archive):
+                os.remove(archive)
+            apply_settings(ereuss,profile.get('ereuss',{}))
+            ereuss.load_image(image_file)
+            apply_settings(ereuss,profile.get('ereuss',{}))
+        ereuss.band_profiler.plot_dpi = gel.ARCHIVE_DPI
+        apply_settings(ereuss.band_profiler,profile.get('band_profiler',{}))
+        ereuss.base_file_name = name
+        if ereuss.original is None:
+            ereuss.write_report(path+htc.PEAK_PROFILE_IMAGE,
+                                path+htc.PEAK_PROFILE_CSV)
+        else:
+            ereuss.transform_image()
+            imsave(path+htc.CURRENT_IMAGE,ereuss.processed)
+            ereuss.find_bands(path+htc.BAND_PROFILE_IMAGE)
+            ereuss.build_report(path+htc.PEAK_PROFILE_IMAGE,
+                                path+htc.PEAK_PROFILE_CSV)
+        ereuss.archive_report(path)
+        row['status'] = 'ok'
+        row['lanes'] = len(ereuss.band_profiler.band_profiles)
+        row['peaks'] = sum(len(p) for p in ereuss.band_profiler.peak_vols)
+        if ereuss.langmuir is not None:
+            row['keq'] = ereuss.langmuir[0]
+            row['keq_error'] = ereuss.langmuir[2]
+    except Exception as err:
+        row['status'] = 'error: {0}'.format(str(err).split('\n')[0])
+    row['seconds'] = '{0:.2f}'.format(time.time()-start)
+    return row
+
+def write_summary(rows,output):
+    """write one line per gel to the summary file in output"""
+    fil = open(os.path.join(output,SUMMARY_FILE),'w')
+    fil.write(';'.join(SUMMARY_COLUMNS)+'\n')
+    for row in rows:
+        fil.write(';'.join(str(row.get(col,'')) for col in SUMMARY_COLUMNS)+'\n')
+    fil.close()
+
+def read_summary(output):
+    """return dictionary of summary rows by gel from a previous run"""
+    file_name = os.path.join(output,SUMMARY_FILE)
+    rows = {}
+    if os.path.exists(file_name):
+        lines = open(file_name).read().strip().split('\n')
+        for line in lines[1:]:
+            row = dict(zip(SUMMARY_COLUMNS,line.split(';')))
+            rows[row['gel']] = row
+    return rows
+
+def run_batch(patterns,output,profile_file=None,workers=1,force=False,
+              cache_folder=None,timings=False):
+    """process all gels in patterns, return list of summary rows"""
+    profile = load_profile(profile_file)
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    previous = read_summary(output)
+    rows = []
+    tasks = []
+    for image_file in find_images(patterns):
+        if not force and up_to_date(image_file,output,profile_file):
+            row = previous.get(gel_name(image_file),{})
+            row.update({'gel':gel_name(image_file),'status':'skipped'})
+            rows.append(row)
+        else:
+            tasks.append((image_file,output,profile,cache_folder,timings))
+    if workers>1 and len(tasks)>1:
+        pool = Pool(workers)
+        try:
+            rows.extend(pool.map(process_gel,tasks))
+        finally:
+            pool.terminate()
+    else:
+        rows.extend(map(process_gel,tasks))
+    rows.sort(key=lambda row: row['gel'])
+    write_summary(rows,output)
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='eReuss batch processing')
+    parser.add_argument('images',nargs='+',
+                        help='image files, directories or glob patterns')
+    parser.add_argument('-p','--profile',default=None,
+                        help='JSON or INI file with processing parameters')
+    parser.add_argument('-o','--output',default='batch',
+                        help='output directory')
+    parser.add_argument('-w','--workers',type=int,default=1,
+                        help='number of worker processes')
+    parser.add_argument('-c','--cache',default=None,
+                        help='folder to keep processing stage results')
+    parser.add_argument('-t','--timings',action='store_true',
+                        help='add stage timings to the reports')
+    parser.add_argument('--force',action='store_true',
+                        help='process gels even if outputs are up to date')
+    args = parser.parse_args()
+    rows = run_batch(args.images,args.output,args.profile,
+                     args.workers,args.force,args.cache,args.timings)
+    for row in rows:
+        print('{0}\t{1}\t{2}s'.format(row['gel'],row['status'],
+                                      row.get('seconds','')))
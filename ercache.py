@@ -0,0 +1,178 @@
+"""Content addressed cache for the eReuss processing stages
+   -------------------------------------------------------
+
+   Results are keyed by a hash of the stage name, the key of its input
+   (the hash of the image file for load_image, the key of the previous
+   stage otherwise) and the exact parameters the stage uses. Keys of
+   one stage are the inputs of the next, so unchanged parameters reuse
+   every earlier stage without rehashing images.
+
+   Cached values are shared and must be treated as read only.
+
+   Files in the cache folder are written to a temporary file and renamed
+   into place, so processes and threads sharing the folder never read a
+   partial entry; unreadable entries are removed and count as misses.
+   The folder is pruned to max_disk_bytes by least recent use.
+"""
+
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def file_hash(file_name):
+    """return sha1 hex digest of the contents of file_name"""
+    sha = hashlib.sha1()
+    fil = open(file_name,'rb')
+    chunk = fil.read(1<<20)
+    while chunk:
+        sha.update(chunk)
+        chunk = fil.read(1<<20)
+    fil.close()
+    return sha.hexdigest()
+
+def stage_key(stage,*parts):
+    """return key for stage with input key and parameters in parts"""
+    return hashlib.sha1(repr((stage,)+parts).encode('utf-8')).hexdigest()
+
+def remove_file(path):
+    """remove path if it still exists"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def value_size(value):
+    """return approximate size in bytes of cached value"""
+    if isinstance(value,np.ndarray):
+        return value.nbytes
+    if isinstance(value,(list,tuple)):
+        return 64+sum(value_size(v) for v in value)
+    return 64
+
+
+class StageCache(object):
+    """LRU cache of stage results up to max_bytes, optionally persisted
+       as pickle files in folder, up to max_disk_bytes
+    """
+
+    def __init__(self,max_bytes=512*1024**2,folder=None,
+                 max_disk_bytes=4*1024**3):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.folder = folder
+        self.entries = OrderedDict()
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if folder is not None and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def disk_path(self,key):
+        return os.path.join(self.folder,key+'.pkl')
+
+    def get(self,key):
+        """return cached value for key, or None"""
+        with self.lock:
+            if key in self.entries:
+                value,size = self.entries.pop(key)
+                self.entries[key] = (value,size)
+                self.hits += 1
+                return value
+        if self.folder is not None and os.path.exists(self.disk_path(key)):
+            value = self.load(key)
+            if value is not None:
+                self.put(key,value,False)
+                with self.lock:
+                    self.hits += 1
+                return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def load(self,key):
+        """return the value of key from its file, or None removing the
+           file if it can not be read
+        """
+        path = self.disk_path(key)
+        try:
+            fil = open(path,'rb')
+            try:
+                value = pickle.load(fil)
+            finally:
+                fil.close()
+            os.utime(path,None)
+            return value
+        except (EOFError,pickle.UnpicklingError,IOError,OSError):
+            remove_file(path)
+            return None
+
+    def put(self,key,value,persist=True):
+        """store value for key, evicting least recently used values"""
+        size = value_size(value)
+        with self.lock:
+            if key in self.entries:
+                self.total -= self.entries.pop(key)[1]
+            self.entries[key] = (value,size)
+            self.total += size
+            while self.total>self.max_bytes and len(self.entries)>1:
+                old_key,(old_value,old_size) = self.entries.popitem(last=False)
+                self.total -= old_size
+        if persist and self.folder is not None:
+            self.save(key,value)
+            self.prune()
+
+    def save(self,key,value):
+        """write value to the file of key through a temporary file"""
+        handle,temp = tempfile.mkstemp(suffix='.tmp',dir=self.folder)
+        try:
+            fil = os.fdopen(handle,'wb')
+            try:
+                pickle.dump(value,fil,pickle.HIGHEST_PROTOCOL)
+            finally:
+                fil.close()
+            try:
+                os.rename(temp,self.disk_path(key))
+            except OSError:
+                # windows does not replace existing files
+                remove_file(self.disk_path(key))
+                os.rename(temp,self.disk_path(key))
+        except:
+            remove_file(temp)
+            raise
+
+    def prune(self):
+        """remove the least recently used files of the folder until
+           their size is under max_disk_bytes
+        """
+        files = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.pkl'):
+                path = os.path.join(self.folder,name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime,stat.st_size,path))
+        total = sum(f[1] for f in files)
+        files.sort()
+        for mtime,size,path in files:
+            if total<=self.max_disk_bytes:
+                break
+            remove_file(path)
+            total -= size
+
+    def call(self,key,func,*args):
+        """return cached value for key or compute, store and return
+           func(*args)
+        """
+        value = self.get(key)
+        if value is None:
+            value = func(*args)
+            self.put(key,value)
+        return value
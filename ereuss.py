@@ -5,17 +5,86 @@
 """
 
 import gel1d as gel
-from skimage.transform import rotate
+import erprofile
+from ercache import file_hash,stage_key
+from skimage.transform import rotate,warp,SimilarityTransform
 import numpy as np
+import io
+import json
+import os
+import struct
 import zipfile
 import xml.etree.cElementTree as ET
 
 
 def array_as_csv(array):
-    res = ''
-    for x in array:
-        res = res+str(x)+';'
-    return res[:-1]
+    return ';'.join(map(str,array))
+
+def csv_as_array(text):
+    """inverse of array_as_csv"""
+    if not text:
+        return np.zeros(0)
+    return np.array(text.split(';'),dtype=float)
+
+def number(text):
+    """int or float value of text, as written by str"""
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+def float_or_none(text):
+    if text == 'None':
+        return None
+    return float(text)
+
+def arrays_as_binary(header,arrays):
+    """return header and the list of (name, array) as bytes:
+       uint32 length of the JSON header, the header padded with spaces
+       to a multiple of 4 bytes and the arrays as little endian float32;
+       header['arrays'] maps each name to [byte offset after the header,
+       shape], so the data can be read with Float32Array views
+    """
+    header = dict(header)
+    header['arrays'] = {}
+    offset = 0
+    for name,arr in arrays:
+        header['arrays'][name] = [offset,list(arr.shape)]
+        offset += 4*arr.size
+    text = json.dumps(header).encode('utf-8')
+    text = text+b' '*(-len(text)%4)
+    parts = [struct.pack('<I',len(text)),text]
+    for name,arr in arrays:
+        parts.append(np.ascontiguousarray(arr,dtype='<f4').tobytes())
+    return b''.join(parts)
+
+def rotation_transform(shape,angle):
+    """return the transform and output shape of
+       skimage.transform.rotate(image, angle, resize=True)
+       for an image of the given shape; the transform maps output
+       (col,row) coordinates to the input image
+    """
+    rows,cols = shape[0],shape[1]
+    center = np.array((cols,rows))/2.0-0.5
+    tform = SimilarityTransform(translation=-center) + \
+            SimilarityTransform(rotation=np.deg2rad(angle)) + \
+            SimilarityTransform(translation=center)
+    corners = np.array([[0,0],[0,rows-1],[cols-1,rows-1],[cols-1,0]])
+    corners = tform.inverse(corners)
+    minc,minr = corners.min(axis=0)
+    maxc,maxr = corners.max(axis=0)
+    out_shape = (int(np.around(maxr-minr+1)),int(np.around(maxc-minc+1)))
+    tform = SimilarityTransform(translation=(minc,minr)) + tform
+    tform.params[2] = (0,0,1)
+    return tform,out_shape
+
+def cached_stage(cache,key,func,*args):
+    """return func(*args) through the stage cache, unless cache or key
+       is None
+    """
+    if cache is None or key is None:
+        return func(*args)
+    return cache.call(key,func,*args)
 
 
 
@@ -27,6 +96,7 @@ class BandProfiler(object):
     
     band_export = [('band_degree','Degree for band baseline'),
                    ('lane_count','Used wells'),
+                   ('lane_search','Lane search'),
                    ('band_text',None,20,40),
                    ('band_x_text',None,20,8)]
     
@@ -34,29 +104,53 @@ class BandProfiler(object):
     <table class="controls">
     <tr><td>[lane_count]</td></tr>
     <tr><td>[band_degree]</td></tr>
+    <tr><td>[lane_search]</td></tr>
     </table><table class="controls">
     <tr><span style="width:20%"><td>X vals</td></span>
     <span style="width:80%"><td>Bands</td></span></tr>
     <tr><span style="width:20%"><td>[band_x_text]</td></span>
     <span style="width:80%"><td>[band_text]</td></span></tr>
     </table>"""
+
+    band_droplists = {'lane_search':['exhaustive','pyramid']}
                    
     peak_export = [('peak_smoothing','Smoothing (pixels)'),
                    ('num_gaussians','Number of Gaussians'),
                    ('min_peak_height','Minimum height (%)'),
+                   ('noise_floor','Noise floor (sigma, 0 off)'),
                    ('baseline_degree','Degree for baseline'),
+                   ('baseline_max_iter','Baseline iterations'),
+                   ('peak_fitter','Peak fitting'),
+                   ('peak_refine','Refine overlapping peaks'),
+                   ('workers','Worker processes'),
                    ('calc_langmuir','Plot Langmuir'),
-                   ('calc_hill','Plot Hill')]
+                   ('langmuir_replicas','Langmuir replicas'),
+                   ('calc_hill','Plot Hill'),
+                   ('curve_solver','Curve fitting'),
+                   ('plot_dpi','Plot DPI'),
+                   ('debug_plot','Debug plot')]
     
     peak_template= """
     <table class="controls">
     <tr><td>[peak_smoothing]</td></tr>
     <tr><td>[baseline_degree]</td></tr>        
+    <tr><td>[baseline_max_iter]</td></tr>
     <tr><td>[min_peak_height]</td></tr>
     <tr><td>[num_gaussians]</td></tr>
+    <tr><td>[noise_floor]</td></tr>
+    <tr><td>[peak_fitter]</td></tr>
+    <tr><td>[peak_refine]</td></tr>
+    <tr><td>[workers]</td></tr>
     <tr><td>[calc_langmuir]</td></tr>
+    <tr><td>[langmuir_replicas]</td></tr>
     <tr><td>[calc_hill]</td></tr>
+    <tr><td>[curve_solver]</td></tr>
+    <tr><td>[plot_dpi]</td></tr>
+    <tr><td>[debug_plot]</td></tr>
     </table>"""
+
+    peak_droplists = {'peak_fitter':gel.GAUSSIAN_FITTERS,
+                      'curve_solver':gel.CURVE_SOLVERS}
     
             
                 
@@ -67,9 +161,18 @@ class BandProfiler(object):
         self.band_x_text_back = ''
         self.band_x_vals = None
         self.band_degree = 5
+        self.lane_search = 'exhaustive'
         self.min_peak_height = 10
+        self.noise_floor = 0.0
         self.peak_smoothing = 0
         self.baseline_degree = 1
+        self.baseline_max_iter = 1000
+        self.baseline_tol = 0.001
+        self.profile_telemetry = []
+        self.lane_telemetry = []
+        self.peak_fitter = 'batch'
+        self.peak_refine = False
+        self.workers = 1
         self.bands = None
         self.profile = None
         self.band_profiles = None
@@ -79,7 +182,17 @@ class BandProfiler(object):
         self.units = 'pixels'
         self.lane_start = 0
         self.calc_langmuir = False
+        self.langmuir_replicas = 500
+        self.langmuir_tol = 0.01
         self.calc_hill = False
+        self.curve_solver = 'lm'
+        self.plot_dpi = 100
+        self.debug_plot = False
+        self.renderer = gel.PlotRenderer()
+        self.lane_fits = {}
+        self.lane_image = None
+        self.cache = None
+        self.image_key = None
         
     def build_band_text(self):
         self.band_text=''
@@ -101,18 +214,26 @@ class BandProfiler(object):
             self.bands.append((int(edges[0]),int(edges[1])))
         self.check_x_vals()
         
+    @erprofile.timed('BandProfiler.find_bands')
     def find_bands(self,image,save_file=None):
         if self.band_text_back == self.band_text:
-            self.bands,self.profile = gel.find_n_bands(image,
-                                      self.lane_count,
-                                      self.band_degree)
+            key = None
+            if self.image_key is not None:
+                key = stage_key('find_n_bands',self.image_key,
+                                self.lane_count,self.band_degree,
+                                self.lane_search,self.baseline_tol,
+                                self.baseline_max_iter)
+            self.bands,self.profile,self.profile_telemetry = cached_stage(
+                                      self.cache,key,self.run_find_n_bands,
+                                      image)
             self.build_band_text()
             self.band_text_back = self.band_text
         else:
             self.build_bands_from_text();
         
         if save_file is not None:
-            gel.save_band_profile(self.profile,self.bands,save_file)        
+            self.renderer.band_profile(self.profile,self.bands,save_file,
+                                       self.plot_dpi)
         
         if self.band_x_text != self.band_x_text_back:
             self.band_x_text_back = self.band_x_text
@@ -121,17 +242,133 @@ class BandProfiler(object):
                 self.band_x_vals.append(float(val))                
         self.check_x_vals()
     
-    def find_peaks(self,image):
-        self.band_profiles = gel.profiles_and_baselines(
-                                           self.bands,
+    def run_find_n_bands(self,image):
+        """return bands, x profile and baseline telemetry for image"""
+        telemetry = []
+        bands,profile = gel.find_n_bands(image,
+                                         self.lane_count,
+                                         self.band_degree,
+                                         self.lane_search,
+                                         self.baseline_tol,
+                                         self.baseline_max_iter,
+                                         telemetry)
+        return bands,profile,telemetry
+    
+    @erprofile.timed('BandProfiler.find_peaks')
+    def find_peaks(self,image,workers=None):
+        """profile and fit all lanes, over workers processes if given
+           or self.workers otherwise
+        """
+        if workers is None:
+            workers = self.workers
+        key = None
+        if self.image_key is not None:
+            key = stage_key('profiles_and_baselines',self.image_key,
+                            [(int(b[0]),int(b[1])) for b in self.bands],
+                            self.min_peak_height,self.num_gaussians,
+                            self.baseline_degree,self.peak_smoothing,
+                            self.peak_fitter,self.baseline_tol,
+                            self.baseline_max_iter,self.noise_floor,
+                            self.peak_refine)
+        self.band_profiles,self.lane_telemetry = cached_stage(
+                                           self.cache,key,
+                                           self.run_profiles,image,workers)
+        self.peak_vols = gel.calc_peaks(self.band_profiles,self.lane_start) 
+
+    def lane_fit_key(self,band):
+        """key of the profile and fits of one lane in lane_fits"""
+        return ((int(band[0]),int(band[1])),self.baseline_degree,
+                self.peak_smoothing,self.peak_fitter,self.baseline_tol,
+                self.baseline_max_iter,self.noise_floor)
+
+    @erprofile.timed('BandProfiler.run_profiles')
+    def run_profiles(self,image,workers):
+        """return band profiles and baseline telemetry of all lanes
+           lanes whose bounds and fit parameters did not change since the
+           last call on the same image reuse their fits, filtered by
+           gel.filter_peaks if min_peak_height or num_gaussians changed;
+           lane_fits keeps the greedy fits, which peak_refine then refines
+           jointly for all lanes
+        """
+        if image is not self.lane_image:
+            self.lane_fits = {}
+            self.lane_image = image
+        min_hei = self.min_peak_height*0.01
+        missing = []
+        for b in self.bands:
+            key = self.lane_fit_key(b)
+            fit = self.lane_fits.get(key)
+            if (fit is None or not gel.peaks_reusable(fit[0][2],fit[1],fit[2],
+                                                      min_hei,
+                                                      self.num_gaussians)) \
+               and b not in missing:
+                missing.append(b)
+        telemetry = []
+        band_profiles = gel.profiles_and_baselines(
+                                           missing,
                                            image,                                          
-                                           self.min_peak_height*0.01,   
+                                           min_hei,   
                                            self.num_gaussians,
                                            self.baseline_degree,
-                                           self.peak_smoothing)
-        self.peak_vols = gel.calc_peaks(self.band_profiles,self.lane_start) 
+                                           self.peak_smoothing,
+                                           self.peak_fitter,
+                                           workers,
+                                           self.baseline_tol,
+                                           self.baseline_max_iter,
+                                           telemetry,
+                                           self.noise_floor)
+        for b,profile,stat in zip(missing,band_profiles,telemetry):
+            self.lane_fits[self.lane_fit_key(b)] = (profile,min_hei,
+                                                    self.num_gaussians,stat)
+        lane_fits = {}
+        band_profiles = []
+        telemetry = []
+        for b in self.bands:
+            key = self.lane_fit_key(b)
+            lane_fits[key] = self.lane_fits[key]
+            (bf,ys,peaks,lane),fit_height,fit_count,stat = lane_fits[key]
+            band_profiles.append((bf,ys,gel.filter_peaks(peaks,min_hei,
+                                                         self.num_gaussians),
+                                  b))
+            telemetry.append(stat)
+        self.lane_fits = lane_fits
+        if self.peak_refine:
+            band_profiles = gel.refine_band_profiles(band_profiles,
+                                                     self.peak_smoothing)
+        return band_profiles,telemetry
         
     
+    def profile_data(self):
+        """return dictionary with x profile, lane bounds, lane values,
+           baselines and gaussian peaks (a, b, c, area) of each lane
+        """
+        data = {'lane_start':self.lane_start,
+                'lanes':[],'x_profile':[],'values':[],'baselines':[],
+                'peaks':[]}
+        if self.bands is not None:
+            data['lanes'] = [[int(b[0]),int(b[1])] for b in self.bands]
+        if self.profile is not None:
+            data['x_profile'] = np.asarray(self.profile,dtype=float).tolist()
+        if self.band_profiles is not None:
+            for vals,baseline,peaks,bands in self.band_profiles:
+                data['values'].append(np.asarray(vals,dtype=float).tolist())
+                data['baselines'].append(np.asarray(baseline,
+                                                    dtype=float).tolist())
+                data['peaks'].append([[float(x) for x in p] for p in peaks])
+        return data
+
+    def profile_json(self):
+        return json.dumps(self.profile_data())
+
+    def profile_binary(self):
+        """return profile_data with x_profile, values and baselines as
+           float32 arrays, see arrays_as_binary
+        """
+        data = self.profile_data()
+        arrays = [(name,np.array(data.pop(name),dtype=np.float32))
+                  for name in ('x_profile','values','baselines')]
+        return arrays_as_binary(data,arrays)
+
     def compute_scale(self,band_sep):
         if len(self.bands)>1:
             b1 = self.bands[0]
@@ -145,15 +382,41 @@ class BandProfiler(object):
             
         
     
+    @erprofile.timed('BandProfiler.report_peaks')
     def report_peaks(self,out_image,out_report):
-        gel.plot_band_peaks(self.band_profiles,out_image,self.lane_start)        
+        self.plot_peaks(out_image)
         gel.report_peaks(self.peak_vols,out_report,self.scale,self.units)    
+
+    def plot_peaks(self,out_image,dpi=None):
+        """plot band peaks at dpi, or self.plot_dpi if not given"""
+        if dpi is None:
+            dpi = self.plot_dpi
+        self.renderer.band_peaks(self.band_profiles,out_image,
+                                 self.lane_start,self.debug_plot,dpi)
         
     def peak_table(self):
         return gel.peak_table(self.peak_vols,self.scale,self.units)
+
+    def baseline_telemetry(self):
+        """return list of (name, BaselineTelemetry) for this gel"""
+        telemetry = [('x profile',stat) for stat in self.profile_telemetry]
+        for ix,stat in enumerate(self.lane_telemetry):
+            telemetry.append(('lane {0}'.format(ix),stat))
+        return telemetry
+
+    def telemetry_table(self):
+        return gel.telemetry_table(self.baseline_telemetry())
     
-    def langmuir(self,file_name):
-        """compute langmuir and save plot if possible"""
+    @erprofile.timed('BandProfiler.langmuir')
+    def langmuir(self,file_name,replicas=None,workers=None):
+        """compute langmuir and save plot if possible
+           replicas and workers for the bootstrap error default to
+           self.langmuir_replicas and self.workers
+        """
+        if replicas is None:
+            replicas = self.langmuir_replicas
+        if workers is None:
+            workers = self.workers
         if self.band_x_vals is not None and len(self.band_x_vals)==len(self.peak_vols):
             ratios = np.array(self.band_x_vals)            
             mobs = []
@@ -163,12 +426,15 @@ class BandProfiler(object):
                 else:
                     mobs.append(b[0][0])
             mobs = np.array(mobs).astype(float)           
-            keq,min_mob, err= gel.langmuir(ratios,mobs)            
-            gel.plot_langmuir(file_name,mobs,ratios,keq,min_mob)
+            keq,min_mob, err= gel.langmuir(ratios,mobs,replicas,workers,
+                                           tol=self.langmuir_tol,
+                                           solver=self.curve_solver)
+            self.renderer.langmuir(file_name,mobs,ratios,keq,min_mob)
             return keq,min_mob,err
         else:
             return None
             
+    @erprofile.timed('BandProfiler.hill')
     def hill(self,file_name):
         """compute hill curve and save plot if possible"""
         if self.band_x_vals is not None and len(self.band_x_vals)==len(self.peak_vols):
@@ -180,8 +446,8 @@ class BandProfiler(object):
                 else:
                     mobs.append(b[0][0])
             mobs = np.array(mobs).astype(float)           
-            norm_mobs, x, err = gel.hill(ratios,mobs)            
-            gel.plot_hill(file_name,norm_mobs,ratios,x[0],x[1])
+            norm_mobs, x, err = gel.hill(ratios,mobs,self.curve_solver)
+            self.renderer.hill(file_name,norm_mobs,ratios,x[0],x[1])
             return x[0],x[1],err
         else:
             return None
@@ -199,7 +465,8 @@ class EReuss(object):
                       ('comb_length','Comb length (cm)'),
                       ('lane_length','Lane end'),
                       ('lane_start','Lane start'),
-                      ('lane_count','Used wells')]
+                      ('lane_count','Used wells'),
+                      ('transform','ROI transform')]
                       
                     
     process_template= """
@@ -209,18 +476,23 @@ class EReuss(object):
     <tr><td>[well_x1]</td><td>[well_y1]</td></tr>
     <tr><td>[well_x2]</td><td>[well_y2]</td></tr>    
     <tr><td>[lane_start]</td><td>[lane_length]</td></tr>        
+    <tr><td>[transform]</td><td></td></tr>
     </table>"""
     
     export_load = [('invert','Invert image'),
-                   ('color','Band color')]
+                   ('color','Band color'),
+                   ('load_mode','Loading')]
                    
     droplists = {'invert':['auto','yes','no'],
-                 'color':['red','green','blue','average']}
+                 'color':['red','green','blue','average'],
+                 'transform':['crop','rotate'],
+                 'load_mode':gel.LOAD_MODES}
     
     load_template= """
     <table class="controls">
     <tr><td>[color]</td></tr>
     <tr><td>[invert]</td></tr>
+    <tr><td>[load_mode]</td></tr>
     </table>"""
         
     export_report = [('base_file_name','Report name'),
@@ -237,8 +509,9 @@ class EReuss(object):
     <tr><td>[calc_langmuir]</td><td>[calc_hill]</td></tr>    
     </table>"""
     
-    def __init__(self):
-        """
+    def __init__(self,cache=None):
+        """cache is an optional ercache.StageCache for the processing
+           stages, which may be shared between instances
         """
         #loading
         self.invert = 'auto'
@@ -253,6 +526,8 @@ class EReuss(object):
         self.lane_length = 0
         self.lane_start = 0
         self.lane_count = 15
+        self.transform = 'crop'
+        self.load_mode = 'memory'
         self.original = None
         self.processed = None        
         
@@ -262,6 +537,10 @@ class EReuss(object):
         self.gel_conc = 0.0
         self.langmuir = None
         self.hill = None
+        self.cache = cache
+        self.original_key = None
+        self.processed_key = None
+        self.timings = erprofile.Recorder()
 
     def check_bounds(self,x1,x2,upper):
         if x1 < 0:
@@ -276,12 +555,19 @@ class EReuss(object):
         return x1,x2
         
         
+    @erprofile.timed('EReuss.load_image')
     def load_image(self,file_name):
         """initialise the frame manager with thelisted images
         """
-        self.original = gel.load_image(file_name,
-                                       self.color,
-                                       self.invert)
+        self.timings.clear()
+        self.original_key = None
+        if self.cache is not None:
+            self.original_key = stage_key('load_image',file_hash(file_name),
+                                          self.color,self.invert,
+                                          self.load_mode)
+        self.original = cached_stage(self.cache,self.original_key,
+                                     gel.load_image_mode,file_name,
+                                     self.color,self.invert,self.load_mode)
         self.well_x1 = 0
         self.well_x2 = self.original.shape[1]
         self.well_y1 = 0
@@ -289,10 +575,13 @@ class EReuss(object):
         self.lane_start = 0
         self.lane_length = self.original.shape[0]               
         self.processed = None   
+        self.processed_key = None
         self.band_profiler = BandProfiler()
+        self.band_profiler.cache = self.cache
         
         
         
+    @erprofile.timed('EReuss.transform_image')
     def transform_image(self):
         """apply transformations to create processed image"""
         self.well_x1,self.well_x2 = self.check_bounds(self.well_x1,
@@ -301,30 +590,81 @@ class EReuss(object):
         self.well_y1,self.well_y2 = self.check_bounds(self.well_y1,
                                                       self.well_y2,
                                                       self.original.shape[0])        
-        angle = np.angle(np.complex(self.well_x2-self.well_x1,
-                                    self.well_y2-self.well_y1),True)
+        self.processed_key = None
+        if self.original_key is not None:
+            self.processed_key = stage_key('transform_image',self.original_key,
+                                           self.well_x1,self.well_y1,
+                                           self.well_x2,self.well_y2,
+                                           self.lane_length,self.transform)
+        if self.transform == 'rotate':
+            transform = self.rotate_and_clip
+        else:
+            transform = self.crop_and_rotate
+        self.processed = cached_stage(self.cache,self.processed_key,
+                                      transform)
+        
+        self.band_profiler.lane_count = self.lane_count
+        self.band_profiler.image_key = self.processed_key
+
+    def well_angle(self):
+        return np.angle(complex(self.well_x2-self.well_x1,
+                                self.well_y2-self.well_y1),True)
+
+    def rotate_and_clip(self):
+        """return the lanes region of the original, rotated to level
+           the wells
+        """
+        angle = self.well_angle()
         img = rotate(self.original,angle, resize=True)
-        top = (self.well_y1 + self.well_y2 + img.shape[0]-self.original.shape[0])/2
+        top = (self.well_y1 + self.well_y2 + img.shape[0]-self.original.shape[0])//2
         bottom = top + self.lane_length
-        left = self.well_x1 + (img.shape[1]-self.original.shape[1])/2
+        left = self.well_x1 + (img.shape[1]-self.original.shape[1])//2
         right = self.well_x2 + (img.shape[1]-self.original.shape[1])
 
-        self.processed = img[top:bottom,left:right]
-        self.processed = self.processed-np.min(self.processed)/np.max(self.processed)
-        
-        self.band_profiler.lane_count = self.lane_count
+        processed = img[top:bottom,left:right]
+        return processed-np.min(processed)/np.max(processed)
+
+    def crop_and_rotate(self):
+        """same as rotate_and_clip, but interpolating only the pixels of
+           the lanes region, with one warp of the rotation transform
+           shifted to the region, instead of rotating the whole image
+        """
+        tform,shape = rotation_transform(self.original.shape,
+                                         self.well_angle())
+        top = (self.well_y1 + self.well_y2 + shape[0]-self.original.shape[0])//2
+        bottom = min(top + self.lane_length,shape[0])
+        left = self.well_x1 + (shape[1]-self.original.shape[1])//2
+        right = min(self.well_x2 + (shape[1]-self.original.shape[1]),shape[1])
+        top,left = max(top,0),max(left,0)
+        tform = SimilarityTransform(translation=(left,top)) + tform
+        tform.params[2] = (0,0,1)
+        processed = warp(self.original,tform,
+                         output_shape=(max(bottom-top,0),max(right-left,0)),
+                         order=1)
+        return processed-np.min(processed)/np.max(processed)
                              
+    @erprofile.timed('EReuss.find_bands')
     def find_bands(self,save_file=None):
         self.band_profiler.find_bands(self.processed,save_file)
 
+    @erprofile.timed('EReuss.build_report')
     def build_report(self,image,csv):
         if self.well_count>1 and self.comb_length>0:
             self.band_profiler.compute_scale(float(self.comb_length)/(self.well_count-1))
         self.band_profiler.lane_start = self.lane_start
         self.band_profiler.find_peaks(self.processed)
+        self.write_report(image,csv)
+
+    @erprofile.timed('EReuss.write_report')
+    def write_report(self,image,csv):
+        """plot and report the current band profiles, with langmuir and
+           hill curves if selected
+        """
         self.band_profiler.report_peaks(image,csv)
+        gel.report_telemetry(self.band_profiler.baseline_telemetry(),csv)
         if self.band_profiler.calc_langmuir:
-            self.langmuir = self.band_profiler.langmuir('html/langmuir.png')
+            self.langmuir = self.band_profiler.langmuir(
+                                os.path.join(os.path.dirname(image),'langmuir.png'))
             fil = open(csv,'a')
             fil.write('\nLangmuir:\nKeq = {0}+-'.format(self.langmuir[0]))
             fil.write('{0}\n'.format(self.langmuir[2]*1.96))
@@ -334,15 +674,19 @@ class EReuss(object):
             self.langmuir=None
         
         if self.band_profiler.calc_hill:
-            self.hill = self.band_profiler.hill('html/hill.png')                
+            self.hill = self.band_profiler.hill(
+                                os.path.join(os.path.dirname(image),'hill.png'))
             fil = open(csv,'a')
             fil.write('\nHill:\nN = {0}\nKeq = {1}\nError =  {2}\n'.format(
                           self.hill[0],self.hill[1],self.hill[2]))
             fil.close()
         else:
             self.hill = None
+        if erprofile.enabled:
+            self.timings.report(csv)
         
         
+    @erprofile.timed('EReuss.save_profiles')
     def save_profiles(self,file_name):    
         """save all profile data to text file
         """
@@ -383,16 +727,110 @@ class EReuss(object):
                               area = str(peak[3]))    
         tree = ET.ElementTree(root)
         tree.write(file_name)
+
+    def save_profile_arrays(self,file_name):
+        """save lane values (float32) and baselines (float64) of all lanes
+           as (lanes x length) arrays in a compressed npz file, with the
+           lane bounds if known and x values if given; baselines keep
+           float64 so that an archive loaded again writes the same XML
+        """
+        profiles = self.band_profiler.band_profiles
+        arrays = {'values':np.array([b_ys[0] for b_ys in profiles]),
+                  'baseline':np.array([b_ys[1] for b_ys in profiles])}
+        bands = self.band_profiler.bands
+        if bands is not None and len(bands) == len(profiles):
+            arrays['lanes'] = np.array(bands)
+        if self.band_profiler.band_x_vals is not None:
+            arrays['x_vals'] = np.array(self.band_profiler.band_x_vals)
+        np.savez_compressed(file_name,**arrays)
            
         
     
+    @erprofile.timed('EReuss.load_archive')
+    def load_archive(self,file_name):
+        """rebuild the state of a gel from a zip file of archive_report,
+           without the images, so that reports can be written again
+           with write_report; the XML is parsed with iterparse, and the
+           lane values and baselines are read from the npz file instead
+           when the archive has one; the lane bounds are only in the npz
+           file, without it bands is empty
+        """
+        self.timings.clear()
+        zf = zipfile.ZipFile(file_name)
+        names = zf.namelist()
+        xml_name = [n for n in names if n.endswith('.xml')][0]
+        self.base_file_name = os.path.splitext(xml_name)[0]
+        npz_name = self.base_file_name+'.npz'
+        arrays = None
+        if npz_name in names:
+            arrays = np.load(io.BytesIO(zf.read(npz_name)))
+        self.original = None
+        self.processed = None
+        self.original_key = None
+        self.processed_key = None
+        self.band_profiler = BandProfiler()
+        self.band_profiler.cache = self.cache
+        profiler = self.band_profiler
+        profiles = []
+        x_vals = []
+        for event,elem in ET.iterparse(zf.open(xml_name)):
+            if elem.tag == 'params':
+                profiler.scale = float_or_none(elem.get('scale'))
+                profiler.units = elem.get('units')
+                self.voltage = float(elem.get('voltage'))
+                self.time = float(elem.get('time'))
+                self.gel_conc = float(elem.get('gel_conc'))
+            elif elem.tag == 'clip':
+                self.well_x1 = int(elem.get('x1'))
+                self.well_y1 = int(elem.get('y1'))
+                self.well_x2 = int(elem.get('x2'))
+                self.well_y2 = int(elem.get('y2'))
+                self.lane_length = int(elem.get('length'))
+                self.lane_start = int(elem.get('start'))
+            elif elem.tag == 'band':
+                ix = len(profiles)
+                if elem.text is not None and elem.text.strip():
+                    x_vals.append(float(elem.text))
+                peaks = [tuple(number(peak.get(k))
+                               for k in ('a','b','c','area'))
+                         for peak in elem.findall('peak')]
+                if arrays is None:
+                    vals = csv_as_array(elem.findtext('values'))
+                    baseline = csv_as_array(elem.findtext('baseline'))
+                    lane = None
+                else:
+                    vals = arrays['values'][ix]
+                    baseline = arrays['baseline'][ix]
+                    lane = None
+                    if 'lanes' in arrays.files:
+                        lane = tuple(int(x) for x in arrays['lanes'][ix])
+                profiles.append((vals,baseline,peaks,lane))
+                elem.clear()
+        zf.close()
+        profiler.band_profiles = profiles
+        profiler.lane_start = self.lane_start
+        profiler.peak_vols = gel.calc_peaks(profiles,self.lane_start)
+        profiler.lane_count = self.lane_count = len(profiles)
+        profiler.bands = [b_ys[3] for b_ys in profiles
+                          if b_ys[3] is not None]
+        profiler.build_band_text()
+        if len(x_vals) == len(profiles) and x_vals:
+            profiler.band_x_vals = x_vals
+            profiler.band_x_text = '\n'.join(str(x) for x in x_vals)
+            profiler.band_x_text_back = profiler.band_x_text
+
+    @erprofile.timed('EReuss.archive_report')
     def archive_report(self,path):
         self.base_file_name = self.base_file_name.replace(' ','_')
         zf = zipfile.ZipFile(path+self.base_file_name+'.zip', 'a')
         self.save_profiles(path+self.base_file_name+'.xml')
+        if self.band_profiler.plot_dpi<gel.ARCHIVE_DPI:
+            self.band_profiler.plot_peaks(path+'bands.png',gel.ARCHIVE_DPI)
         zf.write(path+'image.png','image.png')
         zf.write(path+'bands.png','bands.png')
         zf.write(path+self.base_file_name+'.xml',self.base_file_name+'.xml')
+        self.save_profile_arrays(path+self.base_file_name+'.npz')
+        zf.write(path+self.base_file_name+'.npz',self.base_file_name+'.npz')
         zf.write(path+'bands.csv',self.base_file_name+'.csv')
         if self.langmuir is not None:
             zf.write(path+'langmuir.png','langmuir.png')
@@ -0,0 +1,208 @@
+"""Timing of the eReuss processing stages
+   -----------------------------------
+
+   Functions and methods decorated with timed record wall time, call
+   count and how much each call raised the peak resident memory of the
+   process, per stage name, while profiling is enabled. A stage that
+   stays under the peak of an earlier one shows no growth. When it is disabled the
+   decorators only add one function call and a flag check.
+
+   Stages are accumulated in a process wide table (stats) and, when a
+   timed method runs on an object with a Recorder in its timings
+   attribute, also in that Recorder, which gives the timings of one gel.
+   Counters, such as the number of gaussian fits done and skipped, are
+   kept the same way with count. Worker processes are not included.
+"""
+
+import cProfile
+import functools
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+enabled = False
+"""record stage timings"""
+cprofile_folder = None
+"""folder for the cProfile dump of each request, or None"""
+
+
+def enable(flag=True):
+    global enabled
+    enabled = flag
+
+def peak_rss():
+    """return peak resident memory of the process in MB, or None"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+
+class StageStats(object):
+    """calls, total and longest wall time and largest peak memory
+       growth of a stage
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.growth_mb = None
+
+    def add(self,seconds,growth_mb):
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds,seconds)
+        if growth_mb is not None:
+            self.growth_mb = max(self.growth_mb or 0,growth_mb)
+
+    def as_dict(self):
+        return {'calls':self.calls,'seconds':self.seconds,
+                'max_seconds':self.max_seconds,
+                'rss_growth_mb':self.growth_mb}
+
+
+class Recorder(object):
+    """thread safe table of StageStats by stage name"""
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add(self,name,seconds,growth_mb):
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = StageStats()
+            self.stages[name].add(seconds,growth_mb)
+
+    def count(self,name,value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name,0)+value
+
+    def clear(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+
+    def items(self):
+        """return sorted list of (name, StageStats)"""
+        with self.lock:
+            return sorted(self.stages.items())
+
+    def counter_items(self):
+        """return sorted list of (name, count)"""
+        with self.lock:
+            return sorted(self.counters.items())
+
+    def as_dict(self):
+        return dict((name,stat.as_dict()) for name,stat in self.items())
+
+    def table(self):
+        """html table of the stages"""
+        rows = ["""
+    <table class="result">
+    <tr><th>Stage</th><th>Calls</th><th>Time (ms)</th><th>Max (ms)</th><th>RSS growth (MB)</th></tr>
+    """]
+        for name,stat in self.items():
+            rows.append('<tr><td>{0}</td><td>{1}</td><td>{2:.1f}</td>'
+                        '<td>{3:.1f}</td><td>{4}</td></tr>\n'.format(
+                        name,stat.calls,stat.seconds*1000,
+                        stat.max_seconds*1000,format_mb(stat.growth_mb)))
+        rows.append('</table>')
+        counters = self.counter_items()
+        if counters:
+            rows.append('\n    <table class="result">\n'
+                        '    <tr><th>Counter</th><th>Count</th></tr>\n')
+            for name,value in counters:
+                rows.append('<tr><td>{0}</td><td>{1}</td></tr>\n'.format(
+                            name,value))
+            rows.append('</table>')
+        return ''.join(rows)
+
+    def report(self,file_name):
+        """append the stages to a report file"""
+        lines = ['\nTimings\n',
+                 'Stage\tCalls\tTime (ms)\tMax (ms)\tRSS growth (MB)\n']
+        for name,stat in self.items():
+            lines.append('{0}\t{1}\t{2:.1f}\t{3:.1f}\t{4}\n'.format(
+                         name,stat.calls,stat.seconds*1000,
+                         stat.max_seconds*1000,format_mb(stat.growth_mb)))
+        counters = self.counter_items()
+        if counters:
+            lines.append('\nCounter\tCount\n')
+            for name,value in counters:
+                lines.append('{0}\t{1}\n'.format(name,value))
+        ofil = open(file_name,'a')
+        ofil.writelines(lines)
+        ofil.close()
+
+
+def format_mb(mb):
+    if mb is None:
+        return ''
+    return '{0:.0f}'.format(mb)
+
+stats = Recorder()
+"""stages of all calls in this process"""
+current = threading.local()
+"""Recorder of the gel processed by this thread, in current.recorder"""
+
+
+def record(name,func,args,kwargs):
+    """call func, recording its stage in stats and in the recorder of
+       the current gel; a Recorder in args[0].timings becomes the
+       current one for the duration of the call
+    """
+    recorder = getattr(current,'recorder',None)
+    own = None
+    if args:
+        own = getattr(args[0],'timings',None)
+    if isinstance(own,Recorder) and own is not recorder:
+        current.recorder = own
+    before = peak_rss()
+    start = time.time()
+    try:
+        return func(*args,**kwargs)
+    finally:
+        seconds = time.time()-start
+        growth_mb = None
+        if before is not None:
+            growth_mb = peak_rss()-before
+        stats.add(name,seconds,growth_mb)
+        if getattr(current,'recorder',None) is not None:
+            current.recorder.add(name,seconds,growth_mb)
+        current.recorder = recorder
+
+def count(name,value=1):
+    """add value to counter name in stats and in the recorder of the
+       current gel, while profiling is enabled
+    """
+    if not enabled:
+        return
+    stats.count(name,value)
+    if getattr(current,'recorder',None) is not None:
+        current.recorder.count(name,value)
+
+def timed(name):
+    """decorator recording calls of the function as stage name"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            if not enabled:
+                return func(*args,**kwargs)
+            return record(name,func,args,kwargs)
+        return wrapper
+    return decorate
+
+def profile_call(file_name,func,*args):
+    """return func(*args), run under cProfile with the statistics
+       dumped to file_name
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func,*args)
+    finally:
+        profiler.dump_stats(file_name)
@@ -7,17 +7,93 @@ Python Module of the Week:
     http://pymotw.com/2/BaseHTTPServer/index.html
 """
 
+import matplotlib
+matplotlib.use('Agg')
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from Cookie import SimpleCookie
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import urlparse
 import htmlconstants as htc
 from ereuss import EReuss,BandProfiler
+from ersession import SessionStore,SESSION_COOKIE
+from ercache import StageCache
+from erupload import save_multipart_file,UploadStats
+import erprofile
 from skimage.io import imsave
+import argparse
 import cgi
+import json
 import os
+import time
 
-ereuss = EReuss()
+stage_cache = StageCache()
+"""processing results shared by all sessions, keyed by content"""
+sessions = SessionStore(cache=stage_cache)
+heavy_pool = ThreadPool(cpu_count())
+"""pool running the image processing steps of all sessions"""
+ROUTES = [getattr(htc,name) for name in dir(htc) if name.startswith('URL_')]
+"""paths timed as separate stages, other files are timed together"""
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """Handle each request in a separate thread"""
+    daemon_threads = True
+
+
+def transform_and_save(ereuss,file_name):
+    ereuss.transform_image()
+    imsave(file_name,ereuss.processed)
+
+def load_transform_and_save(ereuss,original,file_name):
+    ereuss.load_image(original)
+    transform_and_save(ereuss,file_name)
    
 class Handler(BaseHTTPRequestHandler):
+
+    def open_session(self):
+        """set self.session from the session cookie, creating a new
+           session if there is no valid cookie; the session is not
+           evicted until close_session
+        """
+        session_id = None
+        cookie = SimpleCookie(self.headers.getheader('Cookie') or '')
+        if SESSION_COOKIE in cookie:
+            session_id = cookie[SESSION_COOKIE].value
+        self.session,self.new_session = sessions.get(session_id)
+
+    def close_session(self):
+        sessions.release(self.session)
+
+    def send_session_cookie(self):
+        if self.new_session:
+            self.send_header('Set-Cookie','{0}={1}; Path=/'.format(
+                             SESSION_COOKIE,self.session.id))
+
+    def run_heavy(self,func,*args):
+        """run func on the shared pool of processing threads, under
+           cProfile if erprofile.cprofile_folder is set
+        """
+        if erprofile.cprofile_folder is not None:
+            file_name = os.path.join(erprofile.cprofile_folder,
+                                     '{0}_{1:.3f}_{2}.prof'.format(
+                                     self.session.id,time.time(),
+                                     func.__name__))
+            return heavy_pool.apply(erprofile.profile_call,
+                                    (file_name,func)+args)
+        return heavy_pool.apply(func,args)
+
+    def run_route(self,method,handler):
+        """return handler(), timed as the route of the request if
+           profiling is enabled
+        """
+        if not erprofile.enabled:
+            return handler()
+        path = urlparse.urlparse(self.path)[2]
+        if path not in ROUTES and path != '/':
+            path = 'file'
+        return erprofile.record(method+' '+path,handler,(),{})
     
     def send_file(self,file_name,contents):
         """call send_header depending on file_name"""
@@ -34,12 +110,17 @@ class Handler(BaseHTTPRequestHandler):
             mimetype='application/javascript'
         if file_name.endswith(".css"):
             mimetype='text/css'
+        if file_name.endswith(".json"):
+            mimetype='application/json'
+        if file_name.endswith(".bin"):
+            mimetype='application/octet-stream'
         if file_name.endswith(".zip"):
             mimetype='application/zip, application/octet-stream'
         
         if mimetype is not None:
             self.send_response(200)            
             self.send_header('Content-type',mimetype)
+            self.send_session_cookie()
             self.end_headers()
             self.wfile.write(contents)            
         return    
@@ -48,9 +129,26 @@ class Handler(BaseHTTPRequestHandler):
         self.send_response(301)       
         self.send_header('Location',url)
         self.send_header( 'Connection', 'close' );
+        self.send_session_cookie()
         self.end_headers()        
     
+    def log_plot_timings(self,*names):
+        timings = self.session.ereuss.band_profiler.renderer.timings
+        for name in names:
+            if name in timings:
+                self.log_message('plot %s: %.1f ms',name,
+                                 timings[name]*1000)
+
     def do_GET(self):
+        """Process GET requests within the session lock"""
+        self.open_session()
+        try:
+            with self.session.lock:
+                self.run_route('GET',self.handle_get_request)
+        finally:
+            self.close_session()
+
+    def handle_get_request(self):
         """Process GET requests
 
         Handles different requests for
@@ -60,6 +158,7 @@ class Handler(BaseHTTPRequestHandler):
             other files
         """
         html='Error 404'
+        ereuss = self.session.ereuss
 
         parsed_url = urlparse.urlparse(self.path)
         path = parsed_url[2]
@@ -75,30 +174,40 @@ class Handler(BaseHTTPRequestHandler):
                                           EReuss.load_template)                
             html = htc.process_html(htc.LOAD_HTML,{htc.HTML_FORM_TAG:form})         
         elif path == htc.URL_IMAGE_PAGE:
-            ereuss.load_image(htc.HTML_FOLDER+htc.ORIGINAL_IMAGE)            
+            self.run_heavy(load_transform_and_save,ereuss,
+                           self.session.file_path(htc.ORIGINAL_IMAGE),
+                           self.session.file_path(htc.CURRENT_IMAGE))
             form = htc.attributes_to_form('imageform',htc.URL_CLIP[1:],
                                           ereuss,EReuss.export_process,
-                                          {},EReuss.process_template) 
-            ereuss.transform_image()
-            imsave(htc.HTML_FOLDER+htc.CURRENT_IMAGE,ereuss.processed)
+                                          EReuss.droplists,
+                                          EReuss.process_template) 
             html = htc.process_html(htc.IMAGE_HTML,{htc.HTML_FORM_TAG:form})            
         elif path == htc.URL_BAND_PAGE:
-            ereuss.find_bands(htc.HTML_FOLDER+htc.BAND_PROFILE_IMAGE)
+            self.run_heavy(ereuss.find_bands,
+                           self.session.file_path(htc.BAND_PROFILE_IMAGE))
+            self.log_plot_timings('band_profile')
             form = htc.attributes_to_form('bandsform',htc.URL_FIND_BANDS[1:],
                                           ereuss.band_profiler,
                                           BandProfiler.band_export,
-                                          {},BandProfiler.band_template)                
+                                          BandProfiler.band_droplists,
+                                          BandProfiler.band_template)                
             html = htc.process_html(htc.BANDS_HTML,{htc.HTML_FORM_TAG:form})     
         elif path == htc.URL_PEAK_PAGE:
-            ereuss.build_report(htc.HTML_FOLDER+htc.PEAK_PROFILE_IMAGE,
-                                htc.HTML_FOLDER+htc.PEAK_PROFILE_CSV)
+            self.run_heavy(ereuss.build_report,
+                           self.session.file_path(htc.PEAK_PROFILE_IMAGE),
+                           self.session.file_path(htc.PEAK_PROFILE_CSV))
+            self.log_plot_timings('band_peaks','band_peaks_debug')
             form = htc.attributes_to_form('peaksform',htc.URL_FIND_PEAKS[1:],
                                           ereuss.band_profiler,
                                           BandProfiler.peak_export,
-                                          {},BandProfiler.peak_template) 
+                                          BandProfiler.peak_droplists,
+                                          BandProfiler.peak_template) 
             html = htc.process_html(htc.PEAKS_HTML,{htc.HTML_FORM_TAG:form})    
         elif path == htc.URL_REPORT_PAGE:
             result = ereuss.band_profiler.peak_table()
+            result = result + ereuss.band_profiler.telemetry_table()
+            if erprofile.enabled:
+                result = result + ereuss.timings.table()
         
             form = htc.attributes_to_form('reportform',htc.URL_DWNLOAD_REPORT[1:],
                                           ereuss,EReuss.export_report,
@@ -106,54 +215,46 @@ class Handler(BaseHTTPRequestHandler):
             html = htc.process_html(htc.REPORT_HTML,
                                     {htc.HTML_RSULT_TAG:result,
                                      htc.HTML_FORM_TAG:form})      
+        elif path == htc.URL_METRICS:
+            file_name = 'metrics.json'
+            html = json.dumps({'enabled':erprofile.enabled,
+                               'stages':erprofile.stats.as_dict(),
+                               'counters':dict(erprofile.stats.counter_items()),
+                               'cache':{'hits':stage_cache.hits,
+                                        'misses':stage_cache.misses,
+                                        'bytes':stage_cache.total}})
+        elif path == htc.URL_PROFILE_JSON:
+            file_name = htc.URL_PROFILE_JSON[1:]
+            html = ereuss.band_profiler.profile_json()
+        elif path == htc.URL_PROFILE_BINARY:
+            file_name = htc.URL_PROFILE_BINARY[1:]
+            html = ereuss.band_profiler.profile_binary()
         else:
-            #if a miscelaneous file is requested, it is only read from the HTML_FOLDER        
-            html = open(htc.HTML_FOLDER+path.split('/')[-1],'rb').read()    
+            #if a miscelaneous file is requested, it is only read from the
+            #session folder or, failing that, the HTML_FOLDER
             file_name=path.split('/')[-1]
+            if os.path.isfile(self.session.file_path(file_name)):
+                html = open(self.session.file_path(file_name),'rb').read()
+            else:
+                html = open(htc.HTML_FOLDER+file_name,'rb').read()    
             
         self.send_file(file_name,html)    
         return
    
     def save_original_image(self,file_name):
-        """Saves the image into the data_path
-        https://gist.github.com/UniIsland/3346170#file-simplehttpserverwithupload-py
+        """Saves the image into the data_path, streaming the multipart
+        body to disk, and logs the upload throughput
         """
-        
-        boundary = self.headers.plisttext.split("=")[1]
-        remainbytes = int(self.headers['content-length'])
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        if not boundary in line:
-            return (False, "Content NOT begin with boundary")
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        line = line.split('filename="')[1]
-        original_name = line.split('"')[0]
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        try:
-            out = open(file_name, 'wb')
-        except IOError:
-            return (False, "Can't create file to write, do you have permission to write?")
-                
-        preline = self.rfile.readline()
-        remainbytes -= len(preline)
-        while remainbytes > 0:
-            line = self.rfile.readline()
-            remainbytes -= len(line)
-            if boundary in line:
-                preline = preline[0:-1]
-                if preline.endswith('\r'):
-                    preline = preline[0:-1]
-                out.write(preline)
-                out.close()
-                return (True, original_name)
-            else:
-                out.write(preline)
-                preline = line
-        return (False, "Unexpect Ends of data.")
+        stats = UploadStats()
+        res = save_multipart_file(self.rfile,
+                                  self.headers.plisttext.split("=")[1],
+                                  int(self.headers['content-length']),
+                                  file_name,stats=stats)
+        if res[0]:
+            self.log_message('upload %s: %d bytes in %.2fs (%.1f MB/s)',
+                             res[1],stats.written,stats.seconds,
+                             stats.throughput())
+        return res
         
         
     def post_data_as_dict(self):
@@ -182,9 +283,11 @@ class Handler(BaseHTTPRequestHandler):
            Source: Huang, Tao at https://gist.github.com/UniIsland/3346170
            Returns (True, session_id) if successful, or (False, error_message) otherwise
         """
+        ereuss = self.session.ereuss
         url = urlparse.urlparse(self.path)[2]
         if url == htc.URL_UPLOAD:            
-            res, msg = self.save_original_image(htc.HTML_FOLDER+htc.ORIGINAL_IMAGE)           
+            res, msg = self.save_original_image(
+                            self.session.file_path(htc.ORIGINAL_IMAGE))
             if res:
                 ereuss.base_file_name = os.path.splitext(msg)[0]
                 return (True, htc.SERVER_URL+htc.URL_LOAD_PAGE)
@@ -201,8 +304,8 @@ class Handler(BaseHTTPRequestHandler):
             htc.form_to_attributes(query,
                                EReuss.export_process,
                                ereuss)        
-            ereuss.transform_image()
-            imsave(htc.HTML_FOLDER+htc.CURRENT_IMAGE,ereuss.processed)                                              
+            self.run_heavy(transform_and_save,ereuss,
+                           self.session.file_path(htc.CURRENT_IMAGE))
             return (True, htc.SERVER_URL+htc.URL_BAND_PAGE)
         elif url ==htc.URL_FIND_BANDS:
             query = self.post_data_as_dict() 
@@ -221,12 +324,17 @@ class Handler(BaseHTTPRequestHandler):
             htc.form_to_attributes(query,                               
                                EReuss.export_report,
                                ereuss) 
-            fn = ereuss.archive_report(htc.HTML_FOLDER)
+            fn = self.run_heavy(ereuss.archive_report,self.session.folder)
             return (True, htc.SERVER_URL+'/'+fn)
         return(False,'/') 
 
     def do_POST(self):
-        (res,msg)=self.handle_post_request()
+        self.open_session()
+        try:
+            with self.session.lock:
+                (res,msg)=self.run_route('POST',self.handle_post_request)
+        finally:
+            self.close_session()
         if not res:
             # upload failed
             self.send_response(200)       
@@ -242,9 +350,20 @@ class Handler(BaseHTTPRequestHandler):
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description='eReuss server')
+    parser.add_argument('--profile',action='store_true',
+                        help='record stage timings, shown at '+htc.URL_METRICS)
+    parser.add_argument('--cprofile',default=None,
+                        help='folder for a cProfile dump of each processing step')
+    args = parser.parse_args()
+    erprofile.enable(args.profile)
+    if args.cprofile is not None:
+        if not os.path.isdir(args.cprofile):
+            os.makedirs(args.cprofile)
+        erprofile.cprofile_folder = args.cprofile
+
     #For safety reasons, server is confined to local host
     #Change 'localhost' to '' to enable remote access
-    #server = ThreadedHTTPServer(('localhost', 8081), Handler)
-    server = HTTPServer(('localhost', 8081), Handler)    
+    server = ThreadedHTTPServer(('localhost', 8081), Handler)
     print 'Starting server, use <Ctrl-C> to stop'
     server.serve_forever()
@@ -0,0 +1,125 @@
+"""Per-user sessions for the eReuss server
+   -------------------------------------
+
+   Each browser gets its own EReuss instance and working folder, keyed
+   by a session cookie. Idle sessions are evicted after a timeout, and
+   the least recently used ones when the arrays held by all sessions
+   exceed a memory cap or there are more than a maximum number of
+   sessions. Sessions handling a request are never evicted.
+"""
+
+import os
+import shutil
+import threading
+import time
+import uuid
+import numpy as np
+from ereuss import EReuss
+
+SESSION_COOKIE = 'ereuss_session'
+SESSION_FOLDER = 'sessions/'
+SESSION_TIMEOUT = 3600
+"""seconds without requests before a session is evicted"""
+SESSION_MEMORY = 2*1024**3
+"""bytes of image and profile arrays held by all sessions"""
+SESSION_LIMIT = 256
+"""number of sessions kept, with their folders"""
+
+
+def session_memory(ereuss):
+    """return approximate bytes of the arrays held by an EReuss,
+       not counting memory maps
+    """
+    total = 0
+    for arr in (ereuss.original,ereuss.processed):
+        if isinstance(arr,np.ndarray) and not isinstance(arr,np.memmap):
+            total += arr.nbytes
+    profiler = getattr(ereuss,'band_profiler',None)
+    if profiler is not None and profiler.band_profiles is not None:
+        for bf,ys,peaks,b in profiler.band_profiles:
+            total += bf.nbytes+ys.nbytes
+    return total
+
+
+class Session(object):
+    """EReuss instance and working folder for one user
+       lock serializes the requests of the session, and users counts
+       the requests between SessionStore.get and SessionStore.release
+    """
+
+    def __init__(self,session_id,folder,cache=None):
+        self.id = session_id
+        self.folder = folder
+        self.ereuss = EReuss(cache)
+        self.lock = threading.Lock()
+        self.last_access = time.time()
+        self.users = 0
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def file_path(self,file_name):
+        return self.folder+file_name
+
+
+class SessionStore(object):
+    """Thread safe collection of sessions with eviction
+       cache is an optional ercache.StageCache shared by all sessions
+    """
+
+    def __init__(self,folder=SESSION_FOLDER,timeout=SESSION_TIMEOUT,
+                 max_memory=SESSION_MEMORY,cache=None,
+                 max_sessions=SESSION_LIMIT):
+        self.folder = folder
+        self.cache = cache
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.max_sessions = max_sessions
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self,session_id=None):
+        """return (session, is_new) for session_id, creating a new
+           session if session_id is unknown; the session is kept from
+           eviction until release is called
+        """
+        with self.lock:
+            session = self.sessions.get(session_id)
+            is_new = session is None
+            if is_new:
+                session_id = uuid.uuid4().hex
+                session = Session(session_id,self.folder+session_id+'/',
+                                  self.cache)
+                self.sessions[session_id] = session
+            session.last_access = time.time()
+            session.users += 1
+            self.evict()
+            return session,is_new
+
+    def release(self,session):
+        """end a request on a session returned by get"""
+        with self.lock:
+            session.users -= 1
+            session.last_access = time.time()
+
+    def remove(self,session):
+        del self.sessions[session.id]
+        shutil.rmtree(session.folder,ignore_errors=True)
+
+    def evict(self):
+        """remove idle sessions, then least recently used sessions until
+           under max_memory and max_sessions; sessions handling a request
+           are kept
+        """
+        now = time.time()
+        by_age = sorted(self.sessions.values(),key=lambda s: s.last_access)
+        memory = dict((s.id,session_memory(s.ereuss)) for s in by_age)
+        total = sum(memory.values())
+        for session in by_age:
+            if now-session.last_access<self.timeout and \
+               total<=self.max_memory and \
+               len(self.sessions)<=self.max_sessions:
+                break
+            if session.users>0:
+                continue
+            self.remove(session)
+            total -= memory[session.id]
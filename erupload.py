@@ -0,0 +1,110 @@
+"""Streaming multipart/form-data upload
+   ----------------------------------
+
+   Reads the body of a file upload in fixed size chunks, searching the
+   closing boundary across chunk edges, and writes the file part straight
+   to disk, so memory stays bounded by the chunk size whatever the file
+   size and the number of newlines in it.
+"""
+
+import time
+
+UPLOAD_CHUNK = 1<<16
+"""bytes read from the request at a time"""
+MAX_PART_HEADER = 1<<14
+"""bytes allowed before the end of the part headers"""
+
+
+class UploadStats(object):
+    """bytes received, bytes written and wall time of an upload"""
+
+    def __init__(self):
+        self.received = 0
+        self.written = 0
+        self.seconds = 0.0
+
+    def throughput(self):
+        """return MB/s received"""
+        if self.seconds<=0:
+            return 0.0
+        return self.received/self.seconds/1024.0**2
+
+
+def as_bytes(text):
+    if isinstance(text,bytes):
+        return text
+    return text.encode('latin-1')
+
+def part_file_name(headers):
+    """return the filename of the Content-Disposition in part headers"""
+    if not b'filename="' in headers:
+        return None
+    name = headers.split(b'filename="')[1].split(b'"')[0]
+    if not isinstance(name,str):
+        name = name.decode('utf-8','replace')
+    return name
+
+def save_multipart_file(rfile,boundary,length,file_name,
+                        chunk_size=UPLOAD_CHUNK,stats=None):
+    """save the first file part of a multipart body of length bytes read
+       from rfile into file_name
+       Returns (True, original file name) if successful, or
+       (False, error_message) otherwise; stats is an optional UploadStats
+    """
+    start = time.time()
+    if stats is None:
+        stats = UploadStats()
+    delimiter = b'--'+as_bytes(boundary)
+    remain = [length]
+
+    def read():
+        if remain[0]<=0:
+            return b''
+        data = rfile.read(min(chunk_size,remain[0]))
+        remain[0] -= len(data)
+        stats.received += len(data)
+        if not data:
+            remain[0] = 0
+        return data
+
+    buf = b''
+    while b'\r\n\r\n' not in buf:
+        data = read()
+        if not data or len(buf)>MAX_PART_HEADER:
+            return (False, "Content NOT begin with boundary")
+        buf += data
+    headers,buf = buf.split(b'\r\n\r\n',1)
+    if not headers.startswith(delimiter):
+        return (False, "Content NOT begin with boundary")
+    original_name = part_file_name(headers)
+    if original_name is None:
+        return (False, "No file in upload")
+    try:
+        out = open(file_name, 'wb')
+    except IOError:
+        return (False, "Can't create file to write, do you have permission to write?")
+    # the part ends at CRLF followed by the boundary, which may be split
+    # between chunks: keep the last len(delimiter)-1 bytes for the next
+    delimiter = b'\r\n'+delimiter
+    keep = len(delimiter)-1
+    try:
+        while True:
+            found = buf.find(delimiter)
+            if found>=0:
+                out.write(buf[:found])
+                stats.written += found
+                break
+            if len(buf)>keep:
+                out.write(buf[:-keep])
+                stats.written += len(buf)-keep
+                buf = buf[-keep:]
+            data = read()
+            if not data:
+                return (False, "Unexpect Ends of data.")
+            buf += data
+    finally:
+        out.close()
+    while read():
+        pass
+    stats.seconds = time.time()-start
+    return (True, original_name)
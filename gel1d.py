@@ -5,17 +5,107 @@
 
 from scipy.optimize import minimize_scalar,minimize
 from skimage import io
+from multiprocessing import Pool
+import time
+from multiprocessing.sharedctypes import RawArray
+import tempfile
 import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+import erprofile
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 
 def band_profile(band,image):
     """returns profile for band"""
-    return np.average(image[:,band[0]:band[1]],axis=1)
+    return lane_profiles([band],image)[0]
 
-def iterative_baseline(vec,degree):
+def lane_profiles(bands,image,dtype=np.float32,tile_rows=256):
+    """returns (lanes x rows) dtype array with the profile of each band,
+       the average of its columns, for all bands in one pass over the
+       image: np.add.reduceat sums the columns between sorted lane edges,
+       in tiles of tile_rows rows, and each lane adds the sums between its
+       edges, so a lane gets the same values with or without the others;
+       integer images are summed in dtype
+    """
+    rows,width = image.shape[:2]
+    x1 = np.clip(np.array([int(b[0]) for b in bands],dtype=int),0,width)
+    x2 = np.clip(np.array([int(b[1]) for b in bands],dtype=int),x1,width)
+    edges = np.unique(np.concatenate((x1,x2)))
+    if len(edges)<2:
+        return np.full((len(bands),rows),np.nan,dtype=dtype)
+    starts = edges[edges<width]
+    acc = image.dtype if image.dtype.kind == 'f' else dtype
+    sums = np.empty((rows,len(starts)),dtype=acc)
+    for start in range(0,rows,tile_rows):
+        sums[start:start+tile_rows] = np.add.reduceat(
+                      image[start:start+tile_rows],starts,axis=1,dtype=acc)
+    lane_sums = np.empty((len(bands),rows))
+    for ix,(lo,hi) in enumerate(zip(np.searchsorted(edges,x1),
+                                    np.searchsorted(edges,x2))):
+        lane_sums[ix] = np.sum(sums[:,lo:hi],axis=1,dtype=float)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return (lane_sums/(x2-x1)[:,None]).astype(dtype)
+
+def median_value(image,tile_rows=256):
+    """returns np.percentile(image,50) by selection (np.partition) on a
+       float32 copy instead of a sorted float64 one; integer images of
+       up to 16 bits are counted in tiles of tile_rows rows instead
+    """
+    size = image.size
+    middle = [(size-1)//2,size//2]
+    if image.dtype.kind in 'ub' and image.dtype.itemsize<=2:
+        counts = np.zeros(1<<(8*image.dtype.itemsize),dtype=np.int64)
+        for start in range(0,image.shape[0],tile_rows):
+            tile = np.ravel(image[start:start+tile_rows])
+            counts += np.bincount(tile,minlength=len(counts))
+        values = np.searchsorted(np.cumsum(counts),middle,side='right')
+    else:
+        flat = np.array(image,dtype=np.float32).ravel()
+        flat.partition(middle)
+        values = flat[middle]
+    return (float(values[0])+float(values[1]))/2
+
+baseline_bases = {}
+
+def baseline_basis(length,degree):
+    """return the orthonormal basis of polynomials up to degree on
+       length points in [0,1], the Q factor of the QR factorization of
+       the Vandermonde matrix, cached for each (length,degree) pair
+    """
+    key = (length,degree)
+    if key not in baseline_bases:
+        xs = np.linspace(0,1,length)
+        baseline_bases[key] = np.linalg.qr(np.vander(xs,degree+1))[0]
+    return baseline_bases[key]
+
+class BaselineTelemetry(object):
+    """iterations, final rho and wall time of an iterative baseline fit
+       for batched fits seconds is the time of the whole call
+    """
+
+    def __init__(self,iterations=0,rho=None,seconds=0.0,converged=False):
+        self.iterations = iterations
+        self.rho = rho
+        self.seconds = seconds
+        self.converged = converged
+
+@erprofile.timed('gel1d.iterative_baseline')
+def iterative_baseline(vec,degree,engine='qr',tol=0.001,max_iter=None,
+                       telemetry=False):
     """computes baseline with a polynomial of specified degree
-       iterates selecting near points to convergence.
+       iterates selecting near points to convergence, until rho<tol
+       or max_iter iterations if max_iter is not None (at least one
+       iteration is done when max_iter<1).
+       engine 'qr' projects on the cached baseline_basis, 'polyfit'
+       refits the polynomial with np.polyfit on every iteration
+       if telemetry is True returns (baseline, BaselineTelemetry)
 
        See:
        Gan, Feng, Guihua Ruan, and Jinyuan Mo.
@@ -24,10 +114,17 @@ def iterative_baseline(vec,degree):
        Chemometrics and Intelligent Laboratory Systems
        82.1 (2006): 59-65.
     """
+    if engine == 'qr':
+        baselines,stats = iterative_baselines([vec],degree,tol,max_iter,True)
+        if telemetry:
+            return baselines[0],stats[0]
+        return baselines[0]
+    start = time.time()
     yscale = np.max(vec)    
     xs = np.linspace(0,1,len(vec))
     ys = vec/yscale
     old_pys = ys
+    iterations = 0
     while True:
         poly = np.polyfit(xs,ys,degree)
         p_ys = np.polyval(poly,xs)
@@ -35,8 +132,55 @@ def iterative_baseline(vec,degree):
         ys[mask] = p_ys[mask]
         rho = np.linalg.norm(p_ys-old_pys)/ \
               np.linalg.norm(p_ys)
-        if rho<0.001:
-            return p_ys*yscale   
+        iterations += 1
+        if rho<tol or (max_iter is not None and iterations>=max_iter):
+            break
+    if telemetry:
+        return p_ys*yscale,BaselineTelemetry(iterations,rho,
+                                             time.time()-start,rho<tol)
+    return p_ys*yscale   
+
+@erprofile.timed('gel1d.iterative_baselines')
+def iterative_baselines(vecs,degree,tol=0.001,max_iter=None,telemetry=False):
+    """computes the iterative_baseline of each of the equal length
+       vectors in vecs, fitting all unconverged vectors in one
+       projection on the cached baseline_basis at each iteration
+       returns a (vectors x length) array, and a list of BaselineTelemetry
+       if telemetry is True
+    """
+    start = time.time()
+    ys = np.array(vecs,dtype=float)
+    yscale = np.max(ys,axis=1)[:,None]
+    ys = ys/yscale
+    basis = baseline_basis(ys.shape[1],degree)
+    baselines = np.zeros(ys.shape)
+    stats = [BaselineTelemetry() for vec in ys]
+    active = np.arange(ys.shape[0])
+    iterations = 0
+    while len(active)>0:
+        current = ys[active]
+        p_ys = np.dot(np.dot(current,basis),basis.T)
+        current = np.minimum(current,p_ys)
+        ys[active] = current
+        rho = np.linalg.norm(p_ys-current,axis=1)/ \
+              np.linalg.norm(p_ys,axis=1)
+        iterations += 1
+        done = rho<tol
+        if max_iter is not None and iterations>=max_iter:
+            done[:] = True
+        for ix,lane in enumerate(active[done]):
+            stats[lane].iterations = iterations
+            stats[lane].rho = rho[done][ix]
+            stats[lane].converged = rho[done][ix]<tol
+        baselines[active[done]] = p_ys[done]
+        active = active[~done]
+    baselines = baselines*yscale
+    if telemetry:
+        seconds = time.time()-start
+        for stat in stats:
+            stat.seconds = seconds
+        return baselines,stats
+    return baselines
     
     
 def gauss_curve(x, a, b, c):
@@ -50,44 +194,467 @@ def gaussian_cost(x, xs, ys, a, b):
     return cost
     
     
-def gaussian_peaks(profile, num_peaks=4,min_height=0):
-    """find peaks by fitting gaussian curves"""
+def gaussian_cost_derivatives(c, sq_dists, ys, a):
+    """return gaussian_cost and its first and second derivatives on the
+       width c, with sq_dists the squared distances to the peak center
+    """
+    curve = a*np.exp(-sq_dists/c)
+    residual = ys-curve
+    weights = np.where(residual>0,0.01,1.0)
+    d_curve = curve*sq_dists/c**2
+    d2_curve = d_curve*(sq_dists/c**2-2.0/c)
+    cost = np.sum(weights*residual**2)
+    grad = -2*np.sum(weights*residual*d_curve)
+    hess = 2*np.sum(weights*(d_curve**2-residual*d2_curve))
+    return cost,grad,hess
+
+def half_max_width(ys, a, b):
+    """return initial guess for the width c from the half height width"""
+    below = ys<a/2.0
+    right = np.argmax(below[b:]) if np.any(below[b:]) else len(ys)-b
+    left = np.argmax(below[b::-1]) if np.any(below[:b+1]) else b+1
+    half_wid = max(1.0,(left+right)/2.0)
+    return half_wid**2/np.log(2)
+
+def newton_width(sq_dists, ys, a, c0, lower, upper, tol=1e-8, max_iter=50):
+    """return the width c minimizing gaussian_cost and the number of cost
+       evaluations, by Newton iterations on log(c) kept inside a bracket
+       between lower and upper that shrinks with the sign of the gradient
+    """
+    lo = np.log(lower)
+    hi = np.log(upper)
+    u = min(max(np.log(c0),lo),hi)
+    for it in range(1,max_iter+1):
+        c = np.exp(u)
+        cost,grad,hess = gaussian_cost_derivatives(c,sq_dists,ys,a)
+        grad_u = c*grad
+        hess_u = c*c*hess+c*grad
+        if grad_u>0:
+            hi = u
+            new_u = u-grad_u/hess_u if hess_u>0 else u-1
+            new_u = max(new_u,(u+lo)/2)
+        else:
+            lo = u
+            new_u = u-grad_u/hess_u if hess_u>0 else u+1
+            new_u = min(new_u,(u+hi)/2)
+        if abs(new_u-u)<tol:
+            return np.exp(new_u),it
+        u = new_u
+    return np.exp(u),max_iter
+
+def noise_level(vals):
+    """return median and robust estimate of the noise standard deviation
+       (from the median absolute deviation) of the baseline corrected
+       values, along the last axis
+    """
+    vals = np.asarray(vals)
+    med = np.median(vals,axis=-1)
+    return med,1.4826*np.median(np.abs(vals-np.expand_dims(med,-1)),axis=-1)
+
+def noise_thresholds(vals,noise_floor):
+    """return the noise level, the minimum peak height above it and the
+       residual energy about it below which no more bands are fitted:
+       noise_floor times the noise sigma, and the energy of pure noise
+       plus noise_floor of its standard deviations
+    """
+    med,sigma = noise_level(vals)
+    rows = np.shape(vals)[-1]
+    return (med,noise_floor*sigma,
+            rows*sigma**2*(1+noise_floor*np.sqrt(2.0/rows)))
+
+def fit_energy(dev,fit,b,c,widths=3.0):
+    """return the energy that the fitted curve removes from the deviations
+       dev within widths standard deviations of its center b, and the
+       number of rows there, along the last axis
+    """
+    half = widths*np.sqrt(np.asarray(c)/2.0)
+    window = np.abs(np.arange(np.shape(dev)[-1])-np.expand_dims(b,-1)) <= \
+             np.expand_dims(half,-1)
+    removed = np.sum(np.where(window,fit*(2*dev-fit),0),axis=-1)
+    return removed,np.maximum(np.sum(window,axis=-1),1)
+
+def count_fits(fits,skipped,flat):
+    """add the fits done, fits skipped by the noise floor and flat lanes
+       to the profiling counters
+    """
+    if not erprofile.enabled:
+        return
+    erprofile.count('gel1d.gaussian_fits',fits)
+    erprofile.count('gel1d.gaussian_fits_skipped',skipped)
+    erprofile.count('gel1d.flat_lanes',flat)
+
+@erprofile.timed('gel1d.gaussian_peaks')
+def gaussian_peaks(profile, num_peaks=4,min_height=0,method='brent',
+                   noise_floor=0):
+    """find peaks by fitting gaussian curves
+       method is 'brent', with scipy minimize_scalar, or 'newton', with
+       newton_width on the analytic derivatives of the cost
+       if noise_floor>0 fitting also stops when the highest residual is
+       below the noise floor or the residual energy is that of noise,
+       see noise_thresholds, and when a fitted curve removes no more than
+       noise_floor**2 times the noise variance per row around its center
+       (fit_energy), which is then dropped: the greedy fits leave
+       residuals well above the noise on the sides of real bands, but
+       curves fitted to them remove little energy
+    """
     peaks = []
-    xvals = range(len(profile))
+    xvals = np.arange(len(profile))
+    sq_table = xvals**2.0
     current = np.copy(profile)
+    if noise_floor>0:
+        level,noise_height,noise_energy = noise_thresholds(current,
+                                                           noise_floor)
     for p in range(num_peaks):
         b = np.argmax(current)
         a = current[b]
         if a<min_height:
             break
-        try:
-            res = minimize_scalar(gaussian_cost,args=(xvals,current,a,b))            
-        except RuntimeError:
-            break
-        fit = gauss_curve(xvals,a,b,res.x)        
+        if noise_floor>0:
+            dev = current-level
+            if a-level<noise_height or np.dot(dev,dev)<=noise_energy:
+                count_fits(p,num_peaks-p,int(p==0))
+                return peaks
+        if method == 'newton':
+            sq_dists = sq_table[np.abs(xvals-b)]
+            c,evals = newton_width(sq_dists,current,a,
+                                   half_max_width(current,a,b),
+                                   1e-2,10.0*len(profile)**2)
+        else:
+            try:
+                res = minimize_scalar(gaussian_cost,args=(xvals,current,a,b))            
+            except RuntimeError:
+                break
+            c = res.x
+        fit = gauss_curve(xvals,a,b,c)        
+        if noise_floor>0:
+            removed,rows = fit_energy(current-level,fit,b,c)
+            if removed<=noise_height**2*rows:
+                count_fits(p+1,num_peaks-p-1,0)
+                return peaks
         area = np.sum(fit)
-        peaks.append((a,b,res.x,area))
+        peaks.append((a,b,c,area))
         current = current-fit            
+    if noise_floor>0:
+        count_fits(len(peaks),0,0)
     return peaks
         
 
+GOLDEN = (np.sqrt(5)-1)/2
+
+def golden_widths(cost,lower,upper,tol=1e-10):
+    """vectorized golden section search of the gaussian width c,
+       in log scale between the lower and upper arrays
+       cost is a function returning the cost array for an array of widths
+    """
+    lo = np.log(lower)
+    hi = np.log(upper)
+    x1 = hi-GOLDEN*(hi-lo)
+    x2 = lo+GOLDEN*(hi-lo)
+    f1 = cost(np.exp(x1))
+    f2 = cost(np.exp(x2))
+    while np.max(hi-lo)>tol:
+        left = f1<f2
+        hi = np.where(left,x2,hi)
+        lo = np.where(left,lo,x1)
+        new_x = np.where(left,hi-GOLDEN*(hi-lo),lo+GOLDEN*(hi-lo))
+        new_f = cost(np.exp(new_x))
+        x2,f2,x1,f1 = (np.where(left,x1,new_x),np.where(left,f1,new_f),
+                       np.where(left,new_x,x2),np.where(left,new_f,f2))
+    return np.exp((lo+hi)/2)
+
+@erprofile.timed('gel1d.gaussian_peaks_batch')
+def gaussian_peaks_batch(profiles, num_peaks=4, min_height=0, noise_floor=0):
+    """find peaks by fitting gaussian curves to all profiles at once
+       profiles is a (lanes x rows) array, returns a list with the
+       (a,b,c,area) peak tuples of each lane, as gaussian_peaks
+       noise_floor stops each lane as in gaussian_peaks
+    """
+    current = np.array(profiles,dtype=float)
+    lanes,rows = current.shape
+    xs = np.arange(rows)
+    peaks = [[] for lane in range(lanes)]
+    active = np.arange(lanes)
+    if noise_floor>0:
+        level,noise_height,noise_energy = noise_thresholds(current,
+                                                           noise_floor)
+        skipped = flat = done = 0
+    for p in range(num_peaks):
+        bs = np.argmax(current[active],axis=1)
+        heights = current[active,bs]
+        keep = heights>=min_height
+        if noise_floor>0:
+            dev = current[active]-level[active,None]
+            noise = (heights-level[active]<noise_height[active]) | \
+                    (np.sum(dev**2,axis=1)<=noise_energy[active])
+            noise = noise & keep
+            skipped += (num_peaks-p)*np.count_nonzero(noise)
+            if p == 0:
+                flat = np.count_nonzero(noise)
+            keep = keep & ~noise
+        active,bs,heights = active[keep],bs[keep],heights[keep]
+        if len(active)==0:
+            break
+        sq_dists = (xs[None,:]-bs[:,None])**2.0
+        ys = current[active]
+
+        def cost(widths):
+            residual = ys-heights[:,None]*np.exp(-sq_dists/widths[:,None])
+            weights = np.where(residual>0,0.01,1.0)
+            return np.sum(weights*residual**2,axis=1)
+
+        widths = golden_widths(cost,np.full(len(active),1e-2),
+                               np.full(len(active),10.0*rows**2))
+        fits = heights[:,None]*np.exp(-sq_dists/widths[:,None])
+        if noise_floor>0:
+            removed,wrows = fit_energy(ys-level[active,None],fits,bs,widths)
+            strong = removed>noise_height[active]**2*wrows
+            done += len(active)
+            skipped += (num_peaks-p-1)*np.count_nonzero(~strong)
+            active,bs,heights = active[strong],bs[strong],heights[strong]
+            widths,fits,ys = widths[strong],fits[strong],ys[strong]
+        areas = np.sum(fits,axis=1)
+        for ix,lane in enumerate(active):
+            peaks[lane].append((heights[ix],bs[ix],widths[ix],areas[ix]))
+        current[active] = ys-fits
+    if noise_floor>0:
+        count_fits(done,skipped,flat)
+    return peaks
+
+GAUSSIAN_FITTERS = ['scalar','newton','batch']
+
+REFINE_WIDTHS = 5.0
+"""standard deviations around its center where a refined curve is kept"""
+
+def peak_windows(a,b,c,lane,lanes,rows,widths=REFINE_WIDTHS):
+    """evaluate gaussian curves of lanes x rows profiles only near their
+       centers, within widths standard deviations
+       returns the curve of each window point, its peak, its row and the
+       (lanes x rows) sum of the curves
+    """
+    half = np.ceil(widths*np.sqrt(c/2.0)).astype(int)+1
+    center = np.floor(b).astype(int)
+    lo = np.clip(center-half,0,rows-1)
+    counts = np.clip(center+half+1,1,rows)-lo
+    ix = np.repeat(np.arange(len(a)),counts)
+    xs = lo[ix]+np.arange(len(ix))-np.repeat(np.cumsum(counts)-counts,counts)
+    g = np.exp(-(xs-b[ix])**2/c[ix])
+    model = np.bincount(lane[ix]*rows+xs,weights=a[ix]*g,
+                        minlength=lanes*rows)
+    return g,ix,xs,model.reshape(lanes,rows)
+
+@erprofile.timed('gel1d.refine_peaks')
+def refine_peaks(profiles,peaks,max_iter=20,tol=1e-6,widths=REFINE_WIDTHS):
+    """jointly refine the (a,b,c) of all peaks of each lane by least
+       squares on the sum of their curves, with Levenberg-Marquardt steps
+       profiles is a (lanes x rows) array and peaks the list of (a,b,c,area)
+       peak tuples of each lane, as from gaussian_peaks; returns the
+       refined peaks in the same order
+       curves are cut at widths standard deviations, so the Jacobian only
+       couples peaks that overlap and one sparse system for all lanes
+       costs time linear in the number of peaks
+    """
+    ys = np.array(profiles,dtype=float)
+    lanes,rows = ys.shape
+    lane = np.repeat(np.arange(lanes),[len(p) for p in peaks])
+    if len(lane)==0:
+        return [list(p) for p in peaks]
+    params = np.array([p[:3] for lane_peaks in peaks for p in lane_peaks],
+                      dtype=float)
+    lower,upper = 1e-2,10.0*rows**2
+    a,b,c = params[:,0],params[:,1],np.clip(params[:,2],lower,upper)
+    lam = np.full(lanes,1e-3)
+    active = np.unique(lane)
+    for it in range(max_iter):
+        is_active = np.zeros(lanes,dtype=bool)
+        is_active[active] = True
+        sel = np.flatnonzero(is_active[lane])
+        pos = np.searchsorted(active,lane[sel])
+        sa,sb,sc = a[sel],b[sel],c[sel]
+        g,ix,xs,model = peak_windows(sa,sb,sc,pos,len(active),rows,widths)
+        residual = ys[active]-model
+        cost = np.sum(residual**2,axis=1)
+        # derivatives of the curves on a, b and log(c)
+        d = xs-sb[ix]
+        ag = sa[ix]*g
+        jac = sparse.coo_matrix((np.concatenate((g,ag*2*d/sc[ix],ag*d*d/sc[ix])),
+                                 (np.tile(pos[ix]*rows+xs,3),
+                                  np.concatenate((3*ix,3*ix+1,3*ix+2)))),
+                                shape=(len(active)*rows,3*len(sel))).tocsr()
+        jtj = (jac.T*jac).tocsc()
+        diag = jtj.diagonal()
+        damp = np.repeat(lam[active][pos],3)*diag+1e-12*np.max(diag)
+        step = spsolve(jtj+sparse.diags(damp,0,format='csc'),
+                       jac.T*residual.ravel())
+        na = sa+step[0::3]
+        nb = sb+step[1::3]
+        nc = sc*np.exp(np.clip(step[2::3],-2,2))
+        bad = (na<=0) | (nb<0) | (nb>rows-1) | (nc<lower) | (nc>upper)
+        na,nb,nc = np.where(bad,sa,na),np.where(bad,sb,nb),np.where(bad,sc,nc)
+        model = peak_windows(na,nb,nc,pos,len(active),rows,widths)[3]
+        new_cost = np.sum((ys[active]-model)**2,axis=1)
+        better = (new_cost<cost) & \
+                 (np.bincount(pos,weights=bad,minlength=len(active))==0)
+        keep = better[pos]
+        a[sel[keep]],b[sel[keep]],c[sel[keep]] = na[keep],nb[keep],nc[keep]
+        lam[active] = np.where(better,lam[active]/10,lam[active]*10)
+        done = np.where(better,cost-new_cost<=tol*cost,lam[active]>1e8)
+        active = active[~done]
+        if len(active)==0:
+            break
+    g,ix,xs,model = peak_windows(a,b,c,np.zeros(len(a),dtype=int),1,rows,
+                                 widths)
+    areas = np.bincount(ix,weights=a[ix]*g,minlength=len(a))
+    refined = [[] for p in peaks]
+    for k in range(len(a)):
+        refined[lane[k]].append((a[k],b[k],c[k],areas[k]))
+    return refined
+
+def refine_band_profiles(band_profiles,smoothing=0):
+    """return band profiles with the peaks of all lanes refined by
+       refine_peaks on their baseline corrected values
+    """
+    if len(band_profiles)==0:
+        return band_profiles
+    vals = [corrected_values(bf,ys,smoothing)
+            for bf,ys,peaks,b in band_profiles]
+    refined = refine_peaks(vals,[p[2] for p in band_profiles])
+    return [(bf,ys,peaks,b) for (bf,ys,old,b),peaks in zip(band_profiles,
+                                                             refined)]
+
+def corrected_values(bf,ys,smoothing=0):
+    """return profile bf corrected by baseline ys, optionally smoothed"""
+    if smoothing>0:
+        #bf = savitzky_golay(bf,window_size=smoothing*2+1, order=4)
+        return np.convolve(bf-ys, np.ones((smoothing,))/smoothing, mode='same')
+    return bf-ys
+
+def lane_baseline(b,image,bl_degree,smoothing=0,bl_tol=0.001,bl_max_iter=None):
+    """return profile, baseline, baseline corrected values and
+       BaselineTelemetry for lane b
+    """
+    bf = band_profile(b,image)
+    ys,stat = iterative_baseline(bf,bl_degree,tol=bl_tol,max_iter=bl_max_iter,
+                                 telemetry=True)
+    return bf,ys,corrected_values(bf,ys,smoothing),stat
+
+worker_image = None
+
+def init_lane_worker(buffer,shape,dtype):
+    """process pool initializer, maps the shared image buffer"""
+    global worker_image
+    worker_image = np.frombuffer(buffer,dtype=dtype).reshape(shape)
+
+def lane_worker(task):
+    """process pool task: baseline and, unless method is None,
+       gaussian peaks for one lane of the shared image
+    """
+    (b,bl_degree,smoothing,bl_tol,bl_max_iter,min_hei,num_gaussians,method,
+     noise_floor) = task
+    bf,ys,vals,stat = lane_baseline(b,worker_image,bl_degree,smoothing,
+                                    bl_tol,bl_max_iter)
+    peaks = None
+    if method is not None:
+        peaks = gaussian_peaks(vals,num_gaussians,min_hei,method,noise_floor)
+    return bf,ys,vals,peaks,stat
+
+def parallel_lanes(bands,image,min_hei,num_gaussians,bl_degree,smoothing,
+                   method,workers,bl_tol=0.001,bl_max_iter=None,noise_floor=0):
+    """run lane_worker for all bands over a pool of workers processes,
+       with the image in shared memory instead of pickled for each task,
+       in float32 only if the image already is, so the results are those
+       of the serial path
+       results are in the same order as bands
+    """
+    if image.dtype == np.float32:
+        dtype,code = np.float32,'f'
+    else:
+        dtype,code = np.float64,'d'
+    buffer = RawArray(code,int(np.prod(image.shape[:2])))
+    np.frombuffer(buffer,dtype=dtype).reshape(image.shape[:2])[:] = image
+    tasks = [(b,bl_degree,smoothing,bl_tol,bl_max_iter,
+              min_hei,num_gaussians,method,noise_floor) for b in bands]
+    pool = Pool(workers,init_lane_worker,(buffer,image.shape[:2],dtype))
+    try:
+        results = pool.map(lane_worker,tasks)
+    finally:
+        pool.terminate()
+    return results
+
+@erprofile.timed('gel1d.profiles_and_baselines')
 def profiles_and_baselines(bands,image, min_hei, num_gaussians, 
-                           bl_degree, smoothing=0):
-    """return list of profiles and list of baseline values"""
-    profiles = []
-    for b in bands:        
-        bf = band_profile(b,image)
-       
-        ys = iterative_baseline(bf,bl_degree)
+                           bl_degree, smoothing=0, fitter='scalar', workers=1,
+                           bl_tol=0.001, bl_max_iter=None, telemetry=None,
+                           noise_floor=0):
+    """return list of profiles and list of baseline values
+       fitter selects gaussian_peaks for each lane, with minimize_scalar
+       ('scalar') or newton_width ('newton'), or gaussian_peaks_batch
+       for all lanes ('batch')
+       with workers>1 lanes are processed in a pool of worker processes
+       bl_tol and bl_max_iter bound the baseline iterations, and the
+       BaselineTelemetry of each lane is appended to the telemetry list
+       noise_floor>0 stops the fits of each lane at the noise of its
+       corrected values, see gaussian_peaks, instead of num_gaussians
+    """
+    if len(bands)==0:
+        return []
+    method = 'newton' if fitter == 'newton' else 'brent'
+    if fitter == 'batch':
+        method = None
+    if workers>1 and len(bands)>1:
+        lanes = parallel_lanes(bands,image,min_hei,num_gaussians,bl_degree,
+                               smoothing,method,workers,bl_tol,bl_max_iter,
+                               noise_floor)
+        vals = np.array([l[2] for l in lanes])
+    else:
+        bfs = lane_profiles(bands,image)
+        baselines,stats = [],[]
+        if len(bands)>0:
+            baselines,stats = iterative_baselines(bfs,bl_degree,bl_tol,
+                                                  bl_max_iter,True)
         if smoothing>0:
-            #bf = savitzky_golay(bf,window_size=smoothing*2+1, order=4)
-            vals = np.convolve(bf-ys, np.ones((smoothing,))/smoothing, mode='same')
+            vals = np.array([corrected_values(bf,ys,smoothing)
+                             for bf,ys in zip(bfs,baselines)])
         else:
-            vals = bf-ys
-        peaks = gaussian_peaks(vals, num_gaussians,min_hei)
+            vals = bfs-baselines
+        lanes = []
+        for bf,ys,v,stat in zip(bfs,baselines,vals,stats):
+            peaks = None
+            if method is not None:
+                peaks = gaussian_peaks(v,num_gaussians,min_hei,method,
+                                       noise_floor)
+            lanes.append((bf,ys,v,peaks,stat))
+    if method is None and len(lanes)>0:
+        all_peaks = gaussian_peaks_batch(vals,num_gaussians,min_hei,
+                                         noise_floor)
+    else:
+        all_peaks = [l[3] for l in lanes]
+    if telemetry is not None:
+        telemetry.extend([l[4] for l in lanes])
+    profiles = []
+    for (bf,ys,vals,p,stat),peaks,b in zip(lanes,all_peaks,bands):
         profiles.append((bf,ys,peaks,b))
     return profiles
 
+def filter_peaks(peaks,min_height,num_peaks):
+    """return the peaks that gaussian_peaks would find with a higher
+       min_height or fewer num_peaks, since peaks are fitted greedily
+       in order the result is a prefix of peaks
+    """
+    res = []
+    for p in peaks[:num_peaks]:
+        if p[0]<min_height:
+            break
+        res.append(p)
+    return res
+
+def peaks_reusable(peaks,fit_height,fit_count,min_height,num_peaks):
+    """True if filter_peaks of the peaks fitted with fit_height and
+       fit_count gives the peaks for min_height and num_peaks
+    """
+    if num_peaks>fit_count:
+        return False
+    return min_height>=fit_height or len(peaks)>=num_peaks
+
 def calc_peaks(profile,lane_start=0):
     """return list of bands with list of tuples for top, volume, height"""
     band_peaks = []
@@ -100,79 +667,117 @@ def calc_peaks(profile,lane_start=0):
     return band_peaks
         
 
+def format_position(pos,length_scale=None):
+    if length_scale is None:
+        if isinstance(pos,(int,np.integer)):
+            return str(pos)
+        return "{0:.2f}".format(pos)
+    return "{0:.2f}".format(pos*length_scale)
+
 def peak_table(peak_vols, length_scale=None, length_unit='pixels'):
-    table = """
+    rows = ["""
     <table class="result">
     <tr><th>Lane</th><th>Position({0})</th><th>Height</th><th>Area</th></tr>
-    """.format(length_unit)
+    """.format(length_unit)]
     for ix, pv in enumerate(peak_vols):
         for p in pv:
-            table = table+'<tr><td>{0}</td>'.format(ix)
-            if length_scale is None:
-                val = str(p[0])
-            else:
-                val = "{0:.2f}".format(p[0]*length_scale)
-            table = table+'<td>{0}</td>'.format(val)
-            table = table+'<td>{0:.2f}</td>'.format(p[2])
-            table = table+'<td>{0:.2f}</td></tr>\n'.format(p[1])
-    table = table +'</table>'
-    return table
+            rows.append('<tr><td>{0}</td><td>{1}</td><td>{2:.2f}</td>'
+                        '<td>{3:.2f}</td></tr>\n'.format(
+                        ix,format_position(p[0],length_scale),p[2],p[1]))
+    rows.append('</table>')
+    return ''.join(rows)
             
         
 
+@erprofile.timed('gel1d.report_peaks')
 def report_peaks(peak_vols, file_name, length_scale=None, length_unit='pixels'):
     positions = ['Positions ('+length_unit+')\n']
     vols = ['Areas\n']
     heights = ['Heights\n']
     for ix, pv in enumerate(peak_vols):
-        spos = str(ix)+'\t'
-        svols = spos
-        shis = spos
-        for p in pv:
-            if length_scale is None:
-                spos = spos + str(p[0])+'\t'
-            else:
-                spos = spos + "{0:.2f}".format(p[0]*length_scale)+'\t'                
-            svols = svols + str(p[1])+'\t'
-            shis = shis + str(p[2])+'\t'
-        positions.append(spos+'\n')
-        vols.append(svols+'\n')
-        heights.append(shis+'\n')
+        lane = str(ix)+'\t'
+        positions.append(lane+''.join(format_position(p[0],length_scale)+'\t'
+                                      for p in pv)+'\n')
+        vols.append(lane+''.join(str(p[1])+'\t' for p in pv)+'\n')
+        heights.append(lane+''.join(str(p[2])+'\t' for p in pv)+'\n')
     ofil = open(file_name,'w')
     ofil.writelines(positions)
     ofil.writelines(heights)
     ofil.writelines(vols)
     ofil.close()
     
-def x_profile(original,bl_degree):
-    """profile projected into the x axis, corrected by baseline"""
+def telemetry_table(telemetry):
+    """html table for list of (name, BaselineTelemetry) tuples"""
+    rows = ["""
+    <table class="result">
+    <tr><th>Baseline</th><th>Iterations</th><th>Rho</th><th>Time (ms)</th><th>Converged</th></tr>
+    """]
+    for name,stat in telemetry:
+        rows.append('<tr><td>{0}</td><td>{1}</td><td>{2:.2e}</td>'
+                    '<td>{3:.1f}</td><td>{4}</td></tr>\n'.format(
+                    name,stat.iterations,stat.rho,stat.seconds*1000,
+                    stat.converged))
+    rows.append('</table>')
+    return ''.join(rows)
+
+def report_telemetry(telemetry, file_name):
+    """append list of (name, BaselineTelemetry) tuples to report file"""
+    lines = ['\nBaseline telemetry\n',
+             'Name\tIterations\tRho\tTime (ms)\tConverged\n']
+    for name,stat in telemetry:
+        lines.append('{0}\t{1}\t{2}\t{3:.1f}\t{4}\n'.format(
+                     name,stat.iterations,stat.rho,stat.seconds*1000,
+                     stat.converged))
+    ofil = open(file_name,'a')
+    ofil.writelines(lines)
+    ofil.close()
+    
+def x_profile(original,bl_degree,bl_tol=0.001,bl_max_iter=None,telemetry=None,
+              tile_rows=256):
+    """profile projected into the x axis, corrected by baseline
+       the BaselineTelemetry of the baseline is appended to the
+       telemetry list if given
+       the image is read in float32 tiles of tile_rows rows
+    """
     ## remove background noise for band identification        
-    img = original.astype(float)-np.percentile(original,50)  ## background
-    img[img<0]=0
-    img = img/np.max(img)
-    ##aver = (np.max(img,axis = 0)+np.average(img,axis=0))/2
-    aver = np.average(img,axis=0)
-    bl = iterative_baseline(aver, bl_degree)
+    background = median_value(original,tile_rows)
+    aver = np.zeros(original.shape[1])
+    for start in range(0,original.shape[0],tile_rows):
+        tile = np.array(original[start:start+tile_rows],dtype=np.float32)
+        tile -= background
+        np.maximum(tile,0,out=tile)
+        aver += np.sum(tile,axis=0)
+    aver = aver/(original.shape[0]*(np.max(original)-background))
+    bl,stat = iterative_baseline(aver, bl_degree, tol=bl_tol,
+                                 max_iter=bl_max_iter, telemetry=True)
+    if telemetry is not None:
+        telemetry.append(stat)
     aver = aver-bl
     aver[aver<0]=0
     aver = aver/np.max(aver)
     return aver
    
 
-def find_n_bands(original,band_count,bl_degree):
-    """Return list of (x1,x2) tuples with x coordinates of each band"""
-    aver = x_profile(original,bl_degree)
+def default_search(length,band_count):
+    """return the (gap,offset,wid) of lane_search when no tuple scores
+       above zero
+    """
+    maxwid = length//band_count
+    return (0,maxwid,(length-maxwid*band_count)//2)
+
+def lane_search_naive(aver,band_count):
+    """return best (gap,offset,wid) for band_count lanes in the x profile
+       brute force search summing each lane slice, kept for benchmarking
+    """
     tot_sum = np.sum(aver)
-    
-    maxwid = len(aver)/band_count    
-    best = (0,maxwid,(len(aver)-maxwid*band_count)/2)
-    bands = None
+    maxwid = len(aver)//band_count
+    best = default_search(len(aver),band_count)
     most_diff = 0
-    
-    for gap in range(1,maxwid/3):
-        for offset in range(1,maxwid/3):
-            available = (len(aver)-offset-gap*(band_count-1))/band_count
-            for wid in range(maxwid/3,available):
+
+    for gap in range(1,maxwid//3):
+        for offset in range(1,maxwid//3):
+            available = (len(aver)-offset-gap*(band_count-1))//band_count
+            for wid in range(maxwid//3,available):
                 tot = 0
                 for b in range(band_count):
                     x1 = offset+b*gap+b*wid
@@ -183,15 +788,179 @@ def find_n_bands(original,band_count,bl_degree):
                 if diff>most_diff:
                     most_diff = diff
                     best = (gap,offset,wid)
-                    
+    return best
+
+def cumulative_profile(aver):
+    """cumulative sum table of the x profile, with a leading zero
+       so that the sum of aver[x1:x2] is table[x2]-table[x1]
+    """
+    table = np.zeros(len(aver)+1)
+    np.cumsum(aver,out=table[1:])
+    return table
+
+def lane_scores(table,tot_sum,band_count,gap,offset,wids):
+    """return the lane search score for each width in wids, for the
+       given gap and offset, using the cumulative sum table
+    """
+    starts = offset+np.arange(band_count)[:,None]*(gap+wids[None,:])
+    tot = np.sum(table[starts+wids]-table[starts],axis=0)
+    return tot/wids/float(band_count)-\
+           (tot_sum-tot)/(1.0+gap*(band_count-1)+offset)
+
+def lane_search(aver,band_count):
+    """return best (gap,offset,wid) for band_count lanes in the x profile
+       same search as lane_search_naive, but each lane sum is taken from
+       a cumulative sum table and all widths are scored at once
+    """
+    table = cumulative_profile(aver)
+    tot_sum = np.sum(aver)
+    maxwid = len(aver)//band_count
+    best = default_search(len(aver),band_count)
+    most_diff = 0
+
+    for gap in range(1,maxwid//3):
+        for offset in range(1,maxwid//3):
+            available = (len(aver)-offset-gap*(band_count-1))//band_count
+            if available<=maxwid//3:
+                continue
+            wids = np.arange(maxwid//3,available)
+            diffs = lane_scores(table,tot_sum,band_count,gap,offset,wids)
+            ix = np.argmax(diffs)
+            if diffs[ix]>most_diff:
+                most_diff = diffs[ix]
+                best = (gap,offset,int(wids[ix]))
+    return best
+
+def downsample_profile(aver,factor=2):
+    """return the x profile averaged over bins of factor pixels"""
+    n = len(aver)//factor*factor
+    return np.average(aver[:n].reshape(-1,factor),axis=1)
+
+def search_limits(length,band_count,factor=1):
+    """return (gap_hi,offset_hi,wid_lo) bounds of lane_search for a profile
+       of length pixels, gaps and offsets below the first two and widths
+       from the last, scaled to a pyramid level factor times coarser so
+       that every full resolution tuple stays inside them
+    """
+    third = length//band_count//3
+    if factor == 1:
+        return third,third,third
+    return ((third-1)//factor+2,(third-1)//factor+2,max(1,third//factor-1))
+
+def tuple_candidates(aver,band_count,tuples,keep,slack=0,limits=None,
+                     spacing=0):
+    """return up to keep (score,(gap,offset,wid)) tuples with the best
+       positive scores among the (n x 3) array of tuples, best first,
+       scored all at once with the score of lane_search, within the
+       bounds of search_limits (limits if given)
+       each returned tuple is more than spacing away in gap or offset
+       from the better ones, so that they are not all in one basin
+       slack widens the largest width so that the last lane may reach
+       the end of the profile, for the rounding on coarse pyramid levels
+    """
+    gap_hi,offset_hi,wid_lo = limits or search_limits(len(aver),band_count)
+    gaps,offsets,wids = np.asarray(tuples).T
+    available = (len(aver)-offsets-gaps*(band_count-1))//band_count
+    inside = (gaps>=1) & (gaps<gap_hi) & (offsets>=1) & \
+             (offsets<offset_hi) & (wids>=wid_lo) & (wids<available+slack)
+    gaps,offsets,wids = gaps[inside],offsets[inside],wids[inside]
+    diffs = lane_scores(cumulative_profile(aver),np.sum(aver),band_count,
+                        gaps,offsets,wids)
+    candidates = []
+    left = diffs>0
+    while len(candidates)<keep and np.any(left):
+        ix = np.flatnonzero(left)[np.argmax(diffs[left])]
+        candidates.append((diffs[ix],(int(gaps[ix]),int(offsets[ix]),
+                                      int(wids[ix]))))
+        left &= (np.abs(gaps-gaps[ix])>spacing) | \
+                (np.abs(offsets-offsets[ix])>spacing)
+    return candidates
+
+def lane_candidates(aver,band_count,keep=1,slack=0,limits=None,spacing=0):
+    """tuple_candidates among all the (gap,offset,wid) tuples within the
+       bounds of search_limits (limits if given)
+    """
+    gap_hi,offset_hi,wid_lo = limits or search_limits(len(aver),band_count)
+    grid = np.mgrid[1:gap_hi,1:offset_hi,wid_lo:len(aver)//band_count+slack]
+    return tuple_candidates(aver,band_count,grid.reshape(3,-1).T,keep,slack,
+                            limits,spacing)
+
+def window_candidates(aver,band_count,centers,radius,keep,slack=0,
+                      limits=None,spacing=0):
+    """tuple_candidates among the (gap,offset,wid) tuples within radius
+       of one of the centers
+    """
+    steps = np.mgrid[-radius:radius+1,-radius:radius+1,
+                     -radius:radius+1].reshape(3,-1).T
+    tuples = (np.asarray(centers)[:,None,:]+steps[None,:,:]).reshape(-1,3)
+    return tuple_candidates(aver,band_count,tuples,keep,slack,limits,spacing)
+
+def lane_search_pyramid(aver,band_count,min_lane=24,radius=2,keep=16,
+                        spacing=3,max_moves=8):
+    """return best (gap,offset,wid) for band_count lanes in the x profile
+       coarse to fine: lane_candidates on the profile halved until lanes
+       are about min_lane pixels wide, then on each finer level the keep
+       best candidates are doubled and searched again within radius,
+       with the lane_search bounds scaled to the level, and again around
+       the new ones, up to max_moves times, while the best one moves
+       profiles too short for a coarser level get lane_candidates at full
+       resolution, which scores the tuples of lane_search all at once
+       candidates are kept spacing apart, since scores along a ridge of
+       lane pitches are close and the coarse levels may order them wrong
+       falls back to lane_search if no coarse candidate is left
+    """
+    factor = 1
+    while len(aver)//(2*factor) >= band_count*min_lane:
+        factor *= 2
+    coarse = factor
+    if factor == 1:
+        candidates = lane_candidates(aver,band_count)
+    else:
+        candidates = lane_candidates(downsample_profile(aver,factor),
+                                     band_count,keep,1,
+                                     search_limits(len(aver),band_count,
+                                                   factor),spacing)
+    while factor>1 and len(candidates)>0:
+        factor //= 2
+        level = aver if factor == 1 else downsample_profile(aver,factor)
+        limits = search_limits(len(aver),band_count,factor)
+        centers = [(2*g,2*o,2*w) for score,(g,o,w) in candidates]
+        for move in range(max_moves):
+            candidates = window_candidates(level,band_count,centers,radius,
+                                           keep,int(factor>1),limits,spacing)
+            if len(candidates)==0 or candidates[0][1] == tuple(centers[0]):
+                break
+            centers = [c for score,c in candidates]
+    if len(candidates)>0:
+        return candidates[0][1]
+    if coarse>1:
+        return lane_search(aver,band_count)
+    return default_search(len(aver),band_count)
+
+def lanes_from_search(best,band_count):
+    """return list of (x1,x2) tuples from the (gap,offset,wid) tuple"""
     bands = []
     gap,offset,wid = best
     for b in range(band_count):
         x1 = offset+b*gap+b*wid
         x2 = x1+wid
         bands.append((x1,x2))
-    
-    return bands,aver
+    return bands
+
+LANE_SEARCHES = {'naive':lane_search_naive,
+                 'exhaustive':lane_search,
+                 'pyramid':lane_search_pyramid}
+
+@erprofile.timed('gel1d.find_n_bands')
+def find_n_bands(original,band_count,bl_degree,search='exhaustive',
+                 bl_tol=0.001,bl_max_iter=None,telemetry=None):
+    """Return list of (x1,x2) tuples with x coordinates of each band
+       search selects the lane search engine, see LANE_SEARCHES
+       the other arguments are passed to x_profile
+    """
+    aver = x_profile(original,bl_degree,bl_tol,bl_max_iter,telemetry)
+    best = LANE_SEARCHES[search](aver,band_count)
+    return lanes_from_search(best,band_count),aver
 
 def save_band_profile(aver,bands,save_image):
     test = np.zeros(len(aver))
@@ -239,6 +1008,151 @@ def plot_band_peaks(band_profiles,out_file,start_line=-1,debug = True):
     plt.savefig(out_file,dpi=300,bbox_inches='tight')
     plt.close()
 
+def nan_joined(segments):
+    """return (xs, ys) of all (xs, ys) segments joined by nan, to draw
+       them as one line
+    """
+    xs = []
+    ys = []
+    for seg_xs,seg_ys in segments:
+        xs.extend([seg_xs,[np.nan]])
+        ys.extend([seg_ys,[np.nan]])
+    if not xs:
+        return [],[]
+    return np.concatenate(xs),np.concatenate(ys)
+
+ARCHIVE_DPI = 300
+
+class PlotRenderer(object):
+    """draws the figures of save_band_profile, plot_band_peaks,
+       plot_langmuir and plot_hill on Agg figures, without pyplot, so
+       that threads with their own renderer can draw at the same time
+       keeps one figure per plot and updates the data of its lines,
+       with all lines of one style merged into a single artist
+       timings has the seconds of the last render of each plot
+    """
+
+    def __init__(self,dpi=100):
+        self.dpi = dpi
+        self.figures = {}
+        self.timings = {}
+
+    def figure(self,name,size,styles):
+        """return figure and lines for plot name, creating them on the
+           first call; styles are (format, linewidth) of each line
+        """
+        if name not in self.figures:
+            fig = Figure(figsize=size)
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot(111)
+            lines = [ax.plot([],[],fmt,linewidth=wid)[0] for fmt,wid in styles]
+            self.figures[name] = (fig,lines)
+        return self.figures[name]
+
+    def save(self,name,fig,out_file,dpi,start):
+        if dpi is None:
+            dpi = self.dpi
+        fig.savefig(out_file,dpi=dpi,bbox_inches='tight')
+        self.timings[name] = time.time()-start
+
+    @erprofile.timed('PlotRenderer.band_profile')
+    def band_profile(self,aver,bands,save_image,dpi=None):
+        """same figure as save_band_profile"""
+        start = time.time()
+        fig,(profile,lanes) = self.figure('band_profile',(10,3),
+                                          [('-',None),('-',None)])
+        test = np.zeros(len(aver))
+        for b in bands:
+            test[b[0]:b[1]] = 0.5
+        profile.set_data(np.arange(len(aver)),aver)
+        lanes.set_data(np.arange(len(test)),test)
+        ax = fig.axes[0]
+        ax.get_yaxis().set_visible(False)
+        ax.axis([0,len(aver),0,1])
+        self.save('band_profile',fig,save_image,dpi,start)
+
+    @erprofile.timed('PlotRenderer.band_peaks')
+    def band_peaks(self,band_profiles,out_file,start_line=-1,debug=False,
+                   dpi=None):
+        """same figures as plot_band_peaks, the debug figure only
+           if debug is True
+        """
+        b,ys,peaks,bands = band_profiles[0]
+        plot_scale = max(b)
+        xs = np.arange(len(ys))
+        if debug:
+            start = time.time()
+            fig,(base,orig) = self.figure('band_peaks_debug',(10,8),
+                                          [('-k',3),('-r',None)])
+            base.set_data(*nan_joined((xs,b_ys[0]/plot_scale+ix+1)
+                                      for ix,b_ys in enumerate(band_profiles)))
+            orig.set_data(*nan_joined((xs,b_ys[1])
+                                      for b_ys in band_profiles))
+            self.rescale(fig)
+            self.save('band_peaks_debug',fig,out_file+'_debug.png',dpi,start)
+
+        start = time.time()
+        fig,(base,curves,marks,line) = self.figure('band_peaks',(10,8),
+                                                   [('-k',3),('-r',None),
+                                                    ('-r',3),('-g',3)])
+        profiles = []
+        gaussians = []
+        tops = []
+        for ix,b_ys in enumerate(band_profiles):
+            b,ys,peaks,bands = b_ys
+            profiles.append((xs,(b-ys)/plot_scale+ix+1))
+            for p in peaks:
+                top = ix+1+p[0]/plot_scale
+                gaussians.append((xs,gauss_curve(xs,p[0]/plot_scale,p[1],p[2])+ix+1))
+                tops.append(([p[1],p[1]],[top,top+0.2]))
+        base.set_data(*nan_joined(profiles))
+        curves.set_data(*nan_joined(gaussians))
+        marks.set_data(*nan_joined(tops))
+        if start_line>=0:
+            line.set_data([start_line,start_line],[0,len(band_profiles)+1])
+        else:
+            line.set_data([],[])
+        self.rescale(fig)
+        self.save('band_peaks',fig,out_file,dpi,start)
+
+    @erprofile.timed('PlotRenderer.langmuir')
+    def langmuir(self,file_name,mobilities,ratios,keq,min_mob,
+                 dpi=ARCHIVE_DPI):
+        """same figure as plot_langmuir"""
+        start = time.time()
+        fig,(points,curve) = self.figure('langmuir',(10,8),
+                                         [('xb',None),('-k',None)])
+        axis_font = {'fontname':'Arial', 'size':'20'}
+        max_mob = np.max(mobilities)
+        points.set_data(ratios,(max_mob-mobilities)/(max_mob-min_mob))
+        xs = np.linspace(0,np.max(ratios)*1.1,200)
+        kr = keq*xs
+        curve.set_data(xs,kr/(1+kr))
+        ax = fig.axes[0]
+        ax.set_ylabel('$ \\Theta = (\\mu_{free}-\\mu)/(\\mu_{free}-\\mu_{min})$',
+                      **axis_font)
+        ax.set_xlabel('[LAC] (nM)',**axis_font)
+        self.rescale(fig)
+        self.save('langmuir',fig,file_name,dpi,start)
+
+    @erprofile.timed('PlotRenderer.hill')
+    def hill(self,file_name,mobs,ratios,n,k,dpi=ARCHIVE_DPI):
+        """same figure as plot_hill"""
+        start = time.time()
+        fig,(points,curve) = self.figure('hill',(10,8),
+                                         [('xb',None),('-k',None)])
+        points.set_data(ratios,mobs)
+        xs = np.linspace(1,np.max(ratios)*1.1,200)
+        ln = np.power(xs,n)
+        curve.set_data(xs,ln/(k+ln))
+        self.rescale(fig)
+        self.save('hill',fig,file_name,dpi,start)
+
+    def rescale(self,fig):
+        ax = fig.axes[0]
+        ax.relim()
+        ax.autoscale_view()
+
 def load_image(input_image,channel='average',invert='auto'):
     orig = io.imread(input_image).astype(float)       
     if len(orig.shape)>2:
@@ -254,6 +1168,79 @@ def load_image(input_image,channel='average',invert='auto'):
         orig=1-orig
     return orig
 
+TIFF_MAGIC = (b'II*\x00',b'MM\x00*')
+
+def is_tiff(input_image):
+    """return True if input_image starts with a TIFF header, whatever
+       its extension (server uploads are saved as png)
+    """
+    fil = open(input_image,'rb')
+    head = fil.read(4)
+    fil.close()
+    return head in TIFF_MAGIC
+
+def image_source(input_image):
+    """return the pixels of input_image without conversion, memory mapped
+       for uncompressed TIFF (with tifffile) and .npy files, read with
+       io.imread otherwise
+    """
+    name = input_image.lower()
+    if name.endswith('.npy'):
+        return np.load(input_image,mmap_mode='r')
+    if tifffile is not None and is_tiff(input_image):
+        try:
+            return tifffile.memmap(input_image,mode='r')
+        except ValueError:
+            pass
+    return io.imread(input_image)
+
+def load_image_tiled(input_image,channel='average',invert='auto',
+                     mapped=False,tile_rows=256):
+    """same as load_image, as a float32 array computed in tiles of
+       tile_rows rows, from a memory mapped source when possible;
+       if mapped, the result is a memory map on a temporary file
+    """
+    source = image_source(input_image)
+    shape = source.shape[:2]
+    if mapped:
+        orig = np.memmap(tempfile.TemporaryFile(),dtype=np.float32,
+                         mode='w+',shape=shape)
+    else:
+        orig = np.empty(shape,dtype=np.float32)
+    for start in range(0,shape[0],tile_rows):
+        tile = orig[start:start+tile_rows]
+        if len(source.shape)>2:
+            tile[:] = 0
+            for ix, col in enumerate(['red','green','blue']):
+                if channel !=col:
+                    tile += source[start:start+tile_rows,:,ix]
+        else:
+            tile[:] = source[start:start+tile_rows]
+    low,high = np.min(orig),np.max(orig)
+    total = 0.0
+    for start in range(0,shape[0],tile_rows):
+        tile = orig[start:start+tile_rows]
+        tile -= low
+        tile /= high-low
+        total += np.sum(tile,dtype=np.float64)
+    if invert == 'yes' or (invert=='auto' and total/orig.size>0.5):
+        for start in range(0,shape[0],tile_rows):
+            tile = orig[start:start+tile_rows]
+            np.subtract(1,tile,out=tile)
+    return orig
+
+LOAD_MODES = ['memory','tiled','mmap']
+
+@erprofile.timed('gel1d.load_image_mode')
+def load_image_mode(input_image,channel='average',invert='auto',
+                    mode='memory'):
+    """load_image with one of LOAD_MODES: memory reads a float64 array,
+       tiled a float32 array, mmap a float32 memory map
+    """
+    if mode == 'memory':
+        return load_image(input_image,channel,invert)
+    return load_image_tiled(input_image,channel,invert,mode=='mmap')
+
 
 
 def langmuir_cost(x,ratios,mobilities):
@@ -262,31 +1249,157 @@ def langmuir_cost(x,ratios,mobilities):
     cost = np.sum((mobilities-preds)**2)
     return cost    
 
-def langmuir(ratios,mobility):
+def langmuir_grad(x,ratios,mobilities):
+    """gradient of langmuir_cost"""
+    kr = x[0]*ratios
+    residuals = mobilities-x[1]*kr/(1+kr)
+    d_keq = x[1]*ratios/(1+kr)**2
+    d_scale = kr/(1+kr)
+    return np.array([-2*np.sum(residuals*d_keq),
+                     -2*np.sum(residuals*d_scale)])
+
+def langmuir_model(x,ratios):
+    """langmuir predictions and jacobian for the (replicas x 2) array
+       of parameters x, as (replicas x lanes) and (replicas x lanes x 2)
+    """
+    kr = x[:,0:1]*ratios
+    preds = x[:,1:2]*kr/(1+kr)
+    jac = np.empty(preds.shape+(2,))
+    jac[:,:,0] = x[:,1:2]*ratios/(1+kr)**2
+    jac[:,:,1] = kr/(1+kr)
+    return preds,jac
+
+def batched_lm(model,x0,ratios,ys,max_iter=200,tol=1e-12):
+    """fit two parameter model to each row of ys by Levenberg-Marquardt,
+       all rows at once
+       model returns predictions and jacobian, see langmuir_model
+       x0 is the (rows x 2) array of starting parameters
+       returns (rows x 2) parameters and the cost of each row
+    """
+    x = np.array(x0,dtype=float)
+    lam = np.full(len(x),1e-3)
+    preds,jac = model(x,ratios)
+    cost = np.sum((ys-preds)**2,axis=1)
+    active = np.ones(len(x),dtype=bool)
+    for it in range(max_iter):
+        res = ys-preds
+        jtj = np.einsum('rli,rlj->rij',jac,jac)
+        grad = np.einsum('rli,rl->ri',jac,res)
+        a = jtj[:,0,0]*(1+lam)
+        d = jtj[:,1,1]*(1+lam)
+        b = jtj[:,0,1]
+        det = a*d-b*b
+        det[det==0] = np.finfo(float).tiny
+        step = np.empty(x.shape)
+        step[:,0] = (d*grad[:,0]-b*grad[:,1])/det
+        step[:,1] = (a*grad[:,1]-b*grad[:,0])/det
+        step[~active] = 0
+        new_x = x+step
+        new_preds,new_jac = model(new_x,ratios)
+        new_cost = np.sum((ys-new_preds)**2,axis=1)
+        better = (new_cost<=cost) & active
+        small = np.max(np.abs(step),axis=1)<=tol*(np.max(np.abs(x),axis=1)+tol)
+        active = active & ~(small | (better & (cost-new_cost<=tol*cost)))
+        x[better] = new_x[better]
+        preds[better] = new_preds[better]
+        jac[better] = new_jac[better]
+        cost[better] = new_cost[better]
+        lam = np.where(better,lam/10,lam*10)
+        if not np.any(active):
+            break
+    return x,cost
+
+def langmuir_replica(task):
+    """fit one bootstrap replica of the langmuir residuals, return keq
+       the replica is resampled with its own seeded random generator
+    """
+    seed,ratios,mobs,residuals,x0 = task
+    rng = np.random.RandomState(seed)
+    sample = mobs+residuals[rng.randint(0,len(mobs),len(mobs))]
+    res = minimize(langmuir_cost,x0,args=(ratios,sample),jac=langmuir_grad)
+    return res.x[0]
+
+def bootstrap_langmuir(ratios,mobs,residuals,x0,replicas=500,workers=1,
+                       seed=0,tol=None,chunk=50):
+    """return the keq values of up to replicas bootstrap fits, each warm
+       started from x0 and seeded with seed plus its index, so the
+       result does not depend on the number of workers
+       fits run in chunks over a pool of workers processes if workers>1;
+       if tol is given, stops when a chunk changes the standard
+       deviation of keq by less than tol, relative
+    """
+    pool = Pool(workers) if workers>1 else None
+    ks = []
+    old_std = None
+    try:
+        for first in range(0,replicas,chunk):
+            tasks = [(seed+ix,ratios,mobs,residuals,x0)
+                     for ix in range(first,min(first+chunk,replicas))]
+            if pool is None:
+                ks.extend(map(langmuir_replica,tasks))
+            else:
+                ks.extend(pool.map(langmuir_replica,tasks))
+            std = np.std(ks)
+            if tol is not None and old_std is not None and \
+               abs(std-old_std)<=tol*std:
+                break
+            old_std = std
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return np.array(ks)
+
+def bootstrap_langmuir_lm(ratios,mobs,residuals,x0,replicas=500,seed=0):
+    """return the keq values of replicas bootstrap fits, all fitted at
+       once by batched_lm, with the same resampling as bootstrap_langmuir
+    """
+    samples = np.empty((replicas,len(mobs)))
+    for ix in range(replicas):
+        rng = np.random.RandomState(seed+ix)
+        samples[ix] = mobs+residuals[rng.randint(0,len(mobs),len(mobs))]
+    x,cost = batched_lm(langmuir_model,np.tile(x0,(replicas,1)),
+                        ratios,samples)
+    return x[:,0]
+
+CURVE_SOLVERS = ['scipy','lm']
+
+@erprofile.timed('gel1d.langmuir')
+def langmuir(ratios,mobility,replicas=500,workers=1,seed=0,tol=None,
+             solver='scipy'):
     """return normalized mobility, Keq and max_mob
        Fits the ka for the langmuir curve (x[0]) and the minimum mobility,
        corresponding to the mobility at infinite ratio (x[1] is a scaling
        factor on the predictions, which gives the minimum mobility as
        max_mob*(1-res.x[0])
+       The error of Keq is the standard deviation over bootstrap_langmuir
+       replicas, see there for replicas, workers, seed and tol
+       solver 'lm' fits with batched_lm and all replicas at once,
+       ignoring workers and tol
     """    
     max_mob = np.max(mobility)
     mobs = (max_mob-mobility)/max_mob    
     scale = 1-np.min(mobility)/max_mob
-    res = minimize(langmuir_cost,[1,scale],args=(ratios,mobs))
-    keq = res.x[0]
-    scale = res.x[1]
+    if solver == 'lm':
+        x,cost = batched_lm(langmuir_model,[[1,scale]],ratios,mobs[None,:])
+        keq,scale = x[0]
+    else:
+        res = minimize(langmuir_cost,[1,scale],args=(ratios,mobs),
+                       jac=langmuir_grad)
+        keq = res.x[0]
+        scale = res.x[1]
     min_mob = max_mob*(1-scale)    
     kr = keq*ratios    
     preds = scale*kr/(1+kr)
     residuals = mobs-preds
-    replicas = 500
-    ks = np.zeros(replicas)
-    for ix in range(replicas):
-        sample = mobs+residuals[np.random.randint(0,len(mobs),len(mobs))]
-        res = minimize(langmuir_cost,[keq,scale],args=(ratios,sample))
-        ks[ix]=res.x[0]
+    if solver == 'lm':
+        ks = bootstrap_langmuir_lm(ratios,mobs,residuals,[keq,scale],
+                                   replicas,seed)
+    else:
+        ks = bootstrap_langmuir(ratios,mobs,residuals,[keq,scale],
+                                replicas,workers,seed,tol)
     return keq,min_mob,np.std(ks)
     
+@erprofile.timed('gel1d.plot_langmuir')
 def plot_langmuir(file_name,mobilities,ratios,keq,min_mob):
     axis_font = {'fontname':'Arial', 'size':'20'}
     max_mob = np.max(mobilities)
@@ -310,13 +1423,32 @@ def hill_cost(x,ratios,mobilities):
     cost = np.sum((mobilities[ratios>0]-preds)**2)
     return cost    
 
-def hill(ratios,mobility):
-    """return normalized mobility, Keq and max_mob"""
+def hill_model(x,ratios):
+    """hill predictions and jacobian for the (replicas x 2) array
+       of parameters x, ratios must be positive, see langmuir_model
+    """
+    ln = np.power(ratios,x[:,0:1])
+    preds = ln/(x[:,1:2]+ln)
+    jac = np.empty(preds.shape+(2,))
+    jac[:,:,0] = x[:,1:2]*ln*np.log(ratios)/(x[:,1:2]+ln)**2
+    jac[:,:,1] = -ln/(x[:,1:2]+ln)**2
+    return preds,jac
+
+@erprofile.timed('gel1d.hill')
+def hill(ratios,mobility,solver='scipy'):
+    """return normalized mobility, Keq and max_mob
+       solver 'lm' fits with batched_lm instead of scipy minimize
+    """
     max_mob = np.max(mobility)
     mobs = (max_mob-mobility)/max_mob    
+    if solver == 'lm':
+        pos = ratios>0
+        x,cost = batched_lm(hill_model,[[1,0.5]],ratios[pos],mobs[None,pos])
+        return mobs,x[0],cost[0]
     res = minimize(hill_cost,[1,0.5],args=(ratios,mobs))
     return mobs,res.x,res.fun
     
+@erprofile.timed('gel1d.plot_hill')
 def plot_hill(file_name,mobs,ratios,n,k):
     plt.figure(figsize=(10,8))                
     plt.plot(ratios,mobs,'xb')
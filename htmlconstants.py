@@ -46,6 +46,15 @@ URL_FIND_PEAKS = '/findpeaks'
 
 URL_REPORT_PAGE = '/report'
 
+URL_METRICS = '/metrics'
+"""GET: stage timings of the server, when started with --profile"""
+URL_PROFILE_JSON = '/profile.json'
+"""GET: x profile, lanes, lane profiles, baselines and peaks as JSON"""
+URL_PROFILE_BINARY = '/profile.bin'
+"""GET: the same with the profiles as float32 arrays, see
+   ereuss.arrays_as_binary
+"""
+
 URL_DWNLOAD_REPORT = '/download'
 
 
@@ -116,7 +125,7 @@ def control_dict(obj,attributes,drop_lists):
                     check = 'checked'
                 else:
                     check = None
-                line = line + create_control('input type="checkbox"',at_name,at_label,check)
+                line = line + create_control('input type="checkbox" value="true"',at_name,at_label,check)
                 # unchecked checkboxes return no value, so this preserves the false
                 # because only the first value is used
                 line = line + create_control('input type="hidden" value="false"',at_name)
@@ -171,7 +180,7 @@ def form_to_attributes(form_data,attributes,obj):
             setattr(obj, at_name, False)
         if at_name in form_data.keys():
             if type(attr) is bool:
-                setattr(obj, at_name, form_data[at_name].upper=='TRUE')
+                setattr(obj, at_name, form_data[at_name].upper()=='TRUE')
             elif type(attr) is int:
                 setattr(obj, at_name, int(form_data[at_name]))
             elif type(attr) is float: